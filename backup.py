@@ -1,65 +1,154 @@
 import os
+import threading
+from time import time
 
 from kubernetes import client
 from kubernetes.client import CoreV1Api
+from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream
 from kubernetes.watch import watch
 
+from cache import ResourceCache
 from job import BackupJob
-from labels import BACKUP_OWNER_LABEL
+from labels import backup_labels, label_selector
+from limits import BackupLimits
+from metrics import BackupMetrics
+from parallel import map_concurrently
 from postgres import PostgresBackup
+from repository import KOPIA_IMAGE, KopiaOptions, KopiaSnapshotResult, kopia_connect_command, kopia_env, \
+    kopia_security_context
+
+# stream() swaps the request method of the ApiClient for a websocket call while it opens the connection and puts
+# back what it saw before. Concurrent opens on one client could leave the websocket call in place for good.
+EXEC_CONNECT_LOCK = threading.Lock()
 
 
 class SnapshotInfo:
-    def __init__(self, name, size, storage_class):
+    def __init__(self, name, size, storage_class, change_hint=None):
         self.name = name
         self.size = size
         self.storage_class = storage_class
+        # Anything which changes whenever the volume content changes, see BackupDefinition.change_hints
+        self.change_hint = change_hint
+
+
+class ExecResult:
+    def __init__(self, pod, exit_code, stdout, stderr):
+        self.pod = pod
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
 
 
 class ExposedSnapshotPvc:
     def __init__(self, pvc_name, snapshot: SnapshotInfo):
         self.pvc_name = pvc_name
         self.snapshot = snapshot
+        # Known once the claim is bound, see Backup.wait_for_exposed_pvcs
+        self.volume: client.V1PersistentVolume | None = None
 
 class Backup:
-    def __init__(self, api_client, owner, namespace):
+    def __init__(self, api_client, owner, namespace, concurrency=8, metrics: BackupMetrics = None,
+                 limits: BackupLimits = None, run_id=None, cache: ResourceCache = None):
         self.client = api_client
         self.core_v1: CoreV1Api = client.CoreV1Api(api_client)
         self.apps_v1 = client.AppsV1Api(api_client)
+        self.storage_v1 = client.StorageV1Api(api_client)
         self.custom_api = client.CustomObjectsApi(api_client)
         self.owner = owner
         self.namespace = namespace
-        self.jobs = BackupJob(api_client, owner, namespace)
-
-
-
-    def exec_in_single_deployment_pod(self, deployment_name, command):
-        # 1. Get the Deployment's label selector
-        deployment = self.apps_v1.read_namespaced_deployment(name=deployment_name, namespace=self.namespace)
-        selector = deployment.spec.selector.match_labels
-        selector_str = self.selector_to_query(selector)
-
-        # 2. List pods matching the selector
-        pods = self.core_v1.list_namespaced_pod(namespace=self.namespace, label_selector=selector_str)
-
-        if not pods.items:
-            print(f"No pods found for deployment: {deployment_name}")
-            return None
-
-        # 3. Select only the first pod
-        target_pod = pods.items[0].metadata.name
-        print(f"Executing command in pod: {target_pod}: {command}")
-
-        # 4. Execute the command
-        resp = stream(self.core_v1.connect_get_namespaced_pod_exec,
-                      target_pod,
-                      self.namespace,
-                      command=command,
-                      stderr=True, stdin=False,
-                      stdout=True, tty=False)
-
-        return resp
+        # Everything created by this run carries the run label as well, so cleanup never touches a concurrent run
+        self.labels = backup_labels(owner, run_id)
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.limits = limits if limits is not None else BackupLimits()
+        self.group_snapshot_version: str | None = None
+        self.group_snapshot_detected = False
+        # Group snapshot name -> version, source PVCs and the SnapshotInfo per PVC filled in once it is cut
+        self.pending_groups: dict[str, tuple[str, dict[str, client.V1PersistentVolumeClaim], dict[str, SnapshotInfo]]] = {}
+        self.binding_modes: dict[str, str] = {}
+        self.cache = cache if cache is not None else ResourceCache(api_client, namespace)
+        self.jobs = BackupJob(api_client, owner, namespace, metrics=metrics, run_id=run_id)
+
+    def exec_in_single_deployment_pod(self, deployment_name, command, timeout=300) -> str:
+        results = self.exec_in_deployment(deployment_name, command, target="one", timeout=timeout)
+        return next(iter(results.values())).stdout
+
+    def exec_in_deployment(self, deployment_name, command, target="one", timeout=300,
+                           leader_lease=None) -> dict[str, ExecResult]:
+        # target: "one" ready pod, "all" ready pods at once, or the "leader" holding leader_lease
+        deployment = self.cache.get("deployments", deployment_name)
+        if deployment is None:
+            raise Exception(f'Deployment {deployment_name} not found in namespace {self.namespace}')
+
+        pods = [pod for pod in self.cache.list("pods", deployment.spec.selector.match_labels) if self.is_pod_ready(pod)]
+        if not pods:
+            raise Exception(f'No ready pods found for deployment {deployment_name}')
+
+        if target == "one":
+            pods = pods[:1]
+        elif target == "leader":
+            if leader_lease is None:
+                raise ValueError("The leader target requires leader_lease")
+
+            holder = client.CoordinationV1Api(self.client).read_namespaced_lease(
+                leader_lease, self.namespace).spec.holder_identity or ""
+            # client-go uses the hostname, optionally followed by "_<uuid>", as identity
+            pods = [pod for pod in pods if holder == pod.metadata.name or holder.startswith(pod.metadata.name + "_")]
+            if not pods:
+                raise Exception(f'Leader {holder} of lease {leader_lease} is not a ready pod of {deployment_name}')
+        elif target != "all":
+            raise ValueError(f'Unsupported exec target {target}')
+
+        results = map_concurrently(lambda pod_name: self.exec_in_pod(pod_name, command, timeout),
+                                   {pod.metadata.name: pod.metadata.name for pod in pods}, len(pods))
+
+        failed = [result for result in results.values() if result.exit_code != 0]
+        if failed:
+            raise Exception(f'Command {command} failed in ' + ", ".join(
+                f'{result.pod} (exit code {result.exit_code}: {result.stderr.strip()[-200:]})' for result in failed))
+
+        return results
+
+    def exec_in_pod(self, pod_name, command, timeout=300) -> ExecResult:
+        print(f"Executing command in pod: {pod_name}: {command}")
+
+        # Only opening the connection is serialized, the commands themselves still run side by side
+        with EXEC_CONNECT_LOCK:
+            resp = stream(self.core_v1.connect_get_namespaced_pod_exec,
+                          pod_name,
+                          self.namespace,
+                          command=command,
+                          stderr=True, stdin=False,
+                          stdout=True, tty=False,
+                          _preload_content=False)
+
+        try:
+            resp.run_forever(timeout=timeout)
+            if resp.is_open():
+                raise TimeoutError(f'Command {command} in pod {pod_name} did not finish within {timeout} seconds')
+
+            stdout, stderr = resp.read_stdout() or "", resp.read_stderr() or ""
+            try:
+                exit_code = resp.returncode
+            except (TypeError, KeyError, IndexError, ValueError):
+                # Nothing on the error channel, e.g. the connection dropped before the command finished
+                exit_code = None
+                stderr += "\nConnection closed without an exit status"
+
+            result = ExecResult(pod_name, exit_code, stdout, stderr)
+        finally:
+            resp.close()
+
+        print(f"Command in pod {pod_name} exited with {result.exit_code}")
+        return result
+
+    def is_pod_ready(self, pod: client.V1Pod) -> bool:
+        if pod.metadata.deletion_timestamp is not None:
+            return False
+
+        return any(condition.type == "Ready" and condition.status == "True"
+                   for condition in (pod.status.conditions or []))
 
     def selector_to_query(self, selector):
         selector_str = ",".join([f"{k}={v}" for k, v in selector.items()])
@@ -72,25 +161,219 @@ class Backup:
             version=version,
             namespace=self.namespace,
             plural="volumesnapshots",
-            label_selector=f'{BACKUP_OWNER_LABEL}={self.owner}')
+            label_selector=label_selector(self.labels))
 
         deleted_snapshots = ", ".join([snapshot["metadata"]["name"] for snapshot in response["items"]])
 
         print(f"Deleted snapshots {deleted_snapshots}")
 
+    def delete_owned_group_snapshots(self):
+        version = self.get_group_snapshot_version()
+        if version is None:
+            return
+
+        self.custom_api.delete_collection_namespaced_custom_object(group="groupsnapshot.storage.k8s.io",
+            version=version,
+            namespace=self.namespace,
+            plural="volumegroupsnapshots",
+            label_selector=label_selector(self.labels))
+
     def delete_owned_pvcs(self):
         self.core_v1.delete_collection_namespaced_persistent_volume_claim(
             namespace=self.namespace,
-            label_selector=f'{BACKUP_OWNER_LABEL}={self.owner}')
+            label_selector=label_selector(self.labels))
 
     def create_snapshot_and_wait(self, pvc_name, snapshot_class=None):
         snapshot = self.create_snapshot(pvc_name, snapshot_class)
         self.wait_for_snapshot(snapshot)
 
-    def create_snapshots(self, pvc_names: dict[str, str], snapshot_class=None) -> dict[str, SnapshotInfo]:
-        return { name : self.create_snapshot(pvc_name, snapshot_class) for name, pvc_name in pvc_names.items() }
+    def create_snapshots(self, pvc_names: dict[str, str], snapshot_class=None, concurrency=None,
+                         group_selector: dict[str, str] = None, group_snapshot_class=None) -> dict[str, SnapshotInfo]:
+        pvcs = self.get_source_pvcs(list(pvc_names.values()))
+
+        if group_selector is not None:
+            group_version = self.get_group_snapshot_version()
+            if group_version is not None:
+                return self.create_group_snapshot(pvc_names, pvcs, group_selector, group_snapshot_class, group_version)
+
+            print("VolumeGroupSnapshots are not available, falling back to one snapshot per PVC")
+
+        return map_concurrently(lambda pvc_name: self.create_snapshot(pvc_name, snapshot_class,
+                                                                      pvcs[pvc_name].spec.storage_class_name),
+                                pvc_names, concurrency or self.concurrency)
+
+    def get_source_pvcs(self, pvc_names: list[str]) -> dict[str, client.V1PersistentVolumeClaim]:
+        # One list call instead of a read per PVC, field selectors only support a single name
+        pvcs = {pvc.metadata.name: pvc for pvc in self.cache.list("persistentvolumeclaims")}
 
-    def create_snapshot(self, pvc_name: str, snapshot_class=None) -> SnapshotInfo:
+        missing = [pvc_name for pvc_name in pvc_names if pvc_name not in pvcs]
+        if missing:
+            raise Exception(f'PVCs {", ".join(missing)} not found in namespace {self.namespace}')
+
+        return pvcs
+
+    def get_group_snapshot_version(self) -> str | None:
+        if not self.group_snapshot_detected:
+            self.group_snapshot_detected = True
+            for api_group in client.ApisApi(self.client).get_api_versions().groups:
+                if api_group.name == "groupsnapshot.storage.k8s.io":
+                    self.group_snapshot_version = api_group.preferred_version.version
+
+        return self.group_snapshot_version
+
+    def create_group_snapshot(self, pvc_names: dict[str, str], pvcs: dict[str, client.V1PersistentVolumeClaim],
+                              selector: dict[str, str], group_snapshot_class, version) -> dict[str, SnapshotInfo]:
+        group = "groupsnapshot.storage.k8s.io"
+
+        group_snapshot_spec = {
+            "apiVersion": group + "/" + version,
+            "kind": "VolumeGroupSnapshot",
+            "metadata": {
+                "generateName": f'{self.owner}-group-',
+                "labels": self.labels
+            },
+            "spec": {
+                "volumeGroupSnapshotClassName": group_snapshot_class,
+                "source": {"selector": {"matchLabels": selector}}
+            }
+        }
+
+        with self.limits.snapshots:
+            group_snapshot = self.custom_api.create_namespaced_custom_object(
+                group=group,
+                version=version,
+                namespace=self.namespace,
+                plural="volumegroupsnapshots",
+                body=group_snapshot_spec,
+            )
+
+        name = group_snapshot['metadata']['name']
+
+        # Capture runs while the application is quiesced, which has to last until the group was cut. Its member
+        # snapshots are only ready once the slowest of them was, they are resolved by wait_for_snapshots after the
+        # application was released.
+        self.wait_for_group_snapshot(name, version, cut_only=True)
+        snapshots = {volume: SnapshotInfo(None, None, pvcs[pvc_name].spec.storage_class_name)
+                     for volume, pvc_name in pvc_names.items()}
+        self.pending_groups[name] = (version, pvcs,
+                                     {pvc_names[volume]: snapshot for volume, snapshot in snapshots.items()})
+
+        return snapshots
+
+    def resolve_group_snapshot(self, name, timeout=3600):
+        group = "groupsnapshot.storage.k8s.io"
+        version, pvcs, snapshots_by_pvc = self.pending_groups.pop(name)
+        status = self.wait_for_group_snapshot(name, version, timeout)
+
+        # The member snapshots are created by the snapshot controller. They are matched to the PVCs through
+        # snapshot handle -> volume handle (from the group content) -> PV -> PVC.
+        group_content = self.custom_api.get_cluster_custom_object(
+            group=group,
+            version=version,
+            plural="volumegroupsnapshotcontents",
+            name=status['boundVolumeGroupSnapshotContentName'])
+
+        content_status = group_content.get('status') or {}
+        handle_pairs = content_status.get('volumeSnapshotHandlePairList') or content_status.get('volumeSnapshotInfoList') or []
+        volume_handles = {pair['snapshotHandle']: pair['volumeHandle'] for pair in handle_pairs}
+
+        # Only the objects involved are read by name, the PVs and snapshot contents of the cluster are never listed
+        volumes = map_concurrently(lambda pvc_name: self.core_v1.read_persistent_volume(pvcs[pvc_name].spec.volume_name),
+                                   {pvc_name: pvc_name for pvc_name in snapshots_by_pvc}, self.concurrency)
+        pvc_by_volume_handle = {volume.spec.csi.volume_handle: pvc_name for pvc_name, volume in volumes.items()
+                                if volume.spec.csi is not None}
+
+        members = {member['metadata']['name']: member for member in self.custom_api.list_namespaced_custom_object(
+                       group="snapshot.storage.k8s.io",
+                       version="v1",
+                       namespace=self.namespace,
+                       plural="volumesnapshots")['items']
+                   if (member.get('status') or {}).get('volumeGroupSnapshotName') == name}
+
+        contents = map_concurrently(lambda member: self.custom_api.get_cluster_custom_object(
+                                        group="snapshot.storage.k8s.io",
+                                        version="v1",
+                                        plural="volumesnapshotcontents",
+                                        name=member['status']['boundVolumeSnapshotContentName']),
+                                    {member_name: member for member_name, member in members.items()
+                                     if member['status'].get('boundVolumeSnapshotContentName')},
+                                    self.concurrency)
+
+        resolved = set()
+        for member_name, content in contents.items():
+            snapshot_handle = (content.get('status') or {}).get('snapshotHandle')
+            pvc_name = pvc_by_volume_handle.get(volume_handles.get(snapshot_handle))
+            if pvc_name is None:
+                continue
+
+            # Owner and run label so cleanup and wait_for_snapshots pick up the member snapshots as well
+            self.custom_api.patch_namespaced_custom_object(
+                group="snapshot.storage.k8s.io",
+                version="v1",
+                namespace=self.namespace,
+                plural="volumesnapshots",
+                name=member_name,
+                body={"metadata": {"labels": self.labels}})
+
+            snapshot = snapshots_by_pvc[pvc_name]
+            snapshot.name = member_name
+            snapshot.size = members[member_name]['status'].get('restoreSize')
+            resolved.add(pvc_name)
+
+        missing = [pvc_name for pvc_name in snapshots_by_pvc if pvc_name not in resolved]
+        if missing:
+            raise Exception(f'VolumeGroupSnapshot {name} does not contain PVCs {", ".join(missing)}')
+
+    def wait_for_group_snapshot(self, name, version, timeout=3600, cut_only=False):
+        # cut_only returns once the point-in-time group snapshot was taken (status.creationTime)
+        group = "groupsnapshot.storage.k8s.io"
+        deadline = time() + timeout
+
+        while True:
+            group_snapshot = self.custom_api.get_namespaced_custom_object(group=group,
+                version=version,
+                namespace=self.namespace,
+                plural="volumegroupsnapshots",
+                name=name)
+
+            status = group_snapshot.get('status') or {}
+            if status.get('readyToUse') or (cut_only and status.get('creationTime')):
+                print(f"Group snapshot {name} {'cut' if cut_only else 'ready'}")
+                return status
+
+            # The last error the snapshot controller saw, it keeps retrying and transient errors clear again
+            if status.get('error'):
+                print(f"Group snapshot {name} reported: {status['error'].get('message')}")
+
+            remaining = int(deadline - time())
+            if remaining <= 0:
+                raise TimeoutError(f'Group snapshot {name} not ready after {timeout} seconds'
+                                   + (f', last error: {status["error"].get("message")}' if status.get('error') else ''))
+
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.custom_api.list_namespaced_custom_object,
+                                      resource_version=group_snapshot['metadata']['resourceVersion'],
+                                      field_selector=f"metadata.name={name}",
+                                      timeout_seconds=remaining,
+                                      group=group,
+                                      version=version,
+                                      namespace=self.namespace,
+                                      plural="volumegroupsnapshots"):
+                    # Reading it again returns it, or fails right away if it was deleted
+                    status = event['object'].get('status') or {}
+                    if status.get('readyToUse') or (cut_only and status.get('creationTime')) \
+                            or event['type'] == 'DELETED':
+                        break
+                    if status.get('error'):
+                        print(f"Group snapshot {name} reported: {status['error'].get('message')}")
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+
+    def create_snapshot(self, pvc_name: str, snapshot_class=None, storage_class=None) -> SnapshotInfo:
         group = "snapshot.storage.k8s.io"
         version = "v1"
 
@@ -99,9 +382,7 @@ class Backup:
             "kind": "VolumeSnapshot",
             "metadata": {
                 "generateName": f'{pvc_name}-snap-',
-                "labels": {
-                    BACKUP_OWNER_LABEL: self.owner
-                }
+                "labels": self.labels
             },
             "spec": {
                 "volumeSnapshotClassName": snapshot_class,
@@ -109,77 +390,124 @@ class Backup:
             }
         }
 
-        # create the resource
-        snapshot = self.custom_api.create_namespaced_custom_object(
-            group=group,
-            version=version,
-            namespace=self.namespace,
-            plural="volumesnapshots",
-            body=snapshot_spec,
-        )
-
-        original_pvc = self.core_v1.read_namespaced_persistent_volume_claim(name=pvc_name, namespace=self.namespace)
-        storage_class = original_pvc.spec.storage_class_name
+        if storage_class is None:
+            original_pvc = self.cache.get("persistentvolumeclaims", pvc_name)
+            if original_pvc is None:
+                raise Exception(f'PVC {pvc_name} not found in namespace {self.namespace}')
+            storage_class = original_pvc.spec.storage_class_name
+
+        # This runs while the application is quiesced, so a throttled storage class only holds its slot for the
+        # create call. The cut is awaited together with all other snapshots, before the application is released.
+        with self.limits.storage_classes.slot(storage_class), self.limits.snapshots:
+            snapshot = self.custom_api.create_namespaced_custom_object(
+                group=group,
+                version=version,
+                namespace=self.namespace,
+                plural="volumesnapshots",
+                body=snapshot_spec,
+            )
 
         return SnapshotInfo(snapshot['metadata']['name'], None, storage_class)
 
-    def wait_for_snapshots(self, snapshots: dict[str, SnapshotInfo]):
-        for snapshot in snapshots.values():
-            self.wait_for_snapshot(snapshot)
-
-    def wait_for_snapshot(self, snapshot: SnapshotInfo):
+    def wait_for_snapshots(self, snapshots: dict[str, SnapshotInfo], timeout=3600, cut_only=False):
+        # cut_only returns as soon as the driver took the point-in-time snapshots (status.creationTime), which is
+        # all the application has to stay quiesced for. readyToUse may take much longer, e.g. for an upload.
         group = "snapshot.storage.k8s.io"
         version = "v1"
-
-        status = self.custom_api.get_namespaced_custom_object_status(group=group,
-            version=version,
-            namespace=self.namespace,
-            plural="volumesnapshots", name=snapshot.name)
-
-        if "status" in status and status['status']['readyToUse']:
-            print(f"Snapshot {snapshot.name} ready")
-            snapshot.size = status['status']['restoreSize']
+        deadline = time() + timeout
+
+        if not cut_only:
+            for name in list(self.pending_groups):
+                self.resolve_group_snapshot(name, timeout)
+
+        # Members of a group snapshot have no name before they are resolved, the group was cut in capture
+        pending = {snapshot.name: snapshot for snapshot in snapshots.values() if snapshot.name is not None}
+        selector = label_selector(self.labels)
+
+        # A single label selected watch covers every snapshot of this run, so all of them are tracked together.
+        # The list is repeated whenever the watch ends, so an expired resource version or a dropped
+        # connection only costs one extra list call.
+        while True:
+            response = self.custom_api.list_namespaced_custom_object(group=group,
+                version=version,
+                namespace=self.namespace,
+                plural="volumesnapshots",
+                label_selector=selector)
+
+            for obj in response['items']:
+                self.update_snapshot_status(pending, obj, cut_only=cut_only)
+
+            listed = {obj['metadata']['name'] for obj in response['items']}
+            missing = [name for name in pending if name not in listed]
+            if missing:
+                raise Exception(f'Snapshots {", ".join(missing)} do not exist (anymore)')
+
+            if not pending:
+                return
+
+            remaining = int(deadline - time())
+            if remaining <= 0:
+                raise TimeoutError(f'Snapshots {", ".join(pending)} not ready after {timeout} seconds')
+
+            print(f"Waiting for snapshots {', '.join(pending)} to be {'cut' if cut_only else 'ready'}")
+
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.custom_api.list_namespaced_custom_object,
+                                      resource_version=response['metadata']['resourceVersion'],
+                                      label_selector=selector,
+                                      timeout_seconds=remaining,
+                                      group=group,
+                                      version=version,
+                                      namespace=self.namespace,
+                                      plural="volumesnapshots"):
+                    self.update_snapshot_status(pending, event['object'], event['type'], cut_only)
+
+                    if not pending:
+                        return
+            except ApiException as e:
+                # 410 Gone: the resource version is too old, list again
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+
+    def update_snapshot_status(self, pending: dict[str, SnapshotInfo], obj, event_type=None, cut_only=False):
+        snapshot = pending.get(obj['metadata']['name'])
+        if snapshot is None:
             return
 
-        resource_version = status['metadata']['resourceVersion']
-
-        w = watch.Watch()
-
-        # Stream events for pods in the given namespace
-        # Use v1.list_pod_for_all_namespaces for cluster-wide watching
-        selector = self.selector_to_query({"metadata.name": snapshot.name})
-
-        print(f"Waiting for snapshot {snapshot.name} to become available")
-        for event in w.stream(self.custom_api.list_namespaced_custom_object,
-                              resource_version=resource_version,
-                              field_selector=selector,
-                              group=group,
-                              version=version,
-                              namespace=self.namespace,
-                              plural="volumesnapshots"):
-            obj = event['object']
-
-            if "status" in obj:
-                status = obj['status']
-                ready_to_use = status['readyToUse']
-
-                if ready_to_use:
-                    w.stop()
+        # A deleted snapshot never becomes ready, there is no point in waiting for the deadline
+        if event_type == 'DELETED':
+            raise Exception(f'Snapshot {snapshot.name} was deleted before it became ready')
+
+        # The last error the snapshot controller saw. It keeps retrying, and transient errors like conflicting
+        # updates clear again, so only the deadline ends the wait.
+        status = obj.get('status') or {}
+        error = status.get('error')
+        if error is not None:
+            print(f"Snapshot {snapshot.name} reported: {error.get('message')}")
+
+        if cut_only and (status.get('creationTime') or status.get('readyToUse')):
+            print(f"Snapshot {snapshot.name} cut")
+            del pending[snapshot.name]
+        elif status.get('readyToUse'):
+            print(f"Snapshot {snapshot.name} ready")
+            snapshot.size = status['restoreSize']
+            del pending[snapshot.name]
 
-        print(f"Snapshot {snapshot.name} ready")
-        snapshot.size = status['restoreSize']
+    def wait_for_snapshot(self, snapshot: SnapshotInfo, timeout=3600):
+        self.wait_for_snapshots({snapshot.name: snapshot}, timeout)
 
-    def expose_snapshots(self, snapshots : dict[str, SnapshotInfo]) -> dict[str, ExposedSnapshotPvc]:
-        return { name: self.expose_snapshot(snapshot) for name, snapshot in snapshots.items() }
+    def expose_snapshots(self, snapshots : dict[str, SnapshotInfo], concurrency=None) -> dict[str, ExposedSnapshotPvc]:
+        return map_concurrently(self.expose_snapshot, snapshots, concurrency or self.concurrency)
 
     def expose_snapshot(self, snapshot) -> ExposedSnapshotPvc:
         # Define the PVC object
         pvc = client.V1PersistentVolumeClaim(
             metadata=client.V1ObjectMeta(
                 generate_name=snapshot.name,
-                labels={
-                    BACKUP_OWNER_LABEL: self.owner
-                }
+                labels=self.labels
             ),
             spec=client.V1PersistentVolumeClaimSpec(
                 # ROX allows the volume to be mounted as read-only by many nodes
@@ -196,43 +524,157 @@ class Backup:
             )
         )
 
-        response = self.core_v1.create_namespaced_persistent_volume_claim(
-            namespace=self.namespace,
-            body=pvc
-        )
+        # A throttled storage class keeps the slot until the driver finished restoring the clone
+        with self.limits.storage_classes.slot(snapshot.storage_class):
+            response = self.core_v1.create_namespaced_persistent_volume_claim(
+                namespace=self.namespace,
+                body=pvc
+            )
+
+            if self.limits.storage_classes.throttled(snapshot.storage_class):
+                self.wait_for_pvc_bound(response.metadata.name, snapshot.storage_class)
 
         return ExposedSnapshotPvc(response.metadata.name, snapshot)
 
-    def run_kopia(self, application: str, scratch_volume: str, cache_volume: str, snapshot_pvcs: dict[str, ExposedSnapshotPvc]):
-        image = "kopia/kopia:0.22.3"
-
-        repository = os.environ["REPOSITORY_URL"]
-        username = os.environ.get("REPOSITORY_USERNAME", "default")
-        password = os.environ.get("REPOSITORY_PASSWORD")
-        hostname = os.environ.get("REPOSITORY_HOSTNAME", "default")
-        server_fingerprint = os.environ.get("SERVER_FINGERPRINT")
-
-        args = [
-            "--disable-file-logging",
-            "--no-check-for-updates",
-            "--cache-directory", "/cache",
-            "--url", f'"{repository}"',
-            f"--override-username='{username}'",
-            f"--override-hostname='{hostname}'"
-        ]
+    def wait_for_exposed_pvcs(self, exposes: dict[str, ExposedSnapshotPvc], timeout=3600) -> dict[str, ExposedSnapshotPvc]:
+        # Restoring the clones is waited for here instead of inside the pending kopia pod, where it can't be told
+        # apart from scheduling problems. Claims with WaitForFirstConsumer are only restored for the kopia pod.
+        pending = {expose.pvc_name: (name, expose) for name, expose in exposes.items()
+                   if not self.waits_for_first_consumer(expose.snapshot.storage_class)}
+        bound: dict[str, str] = {}
+        start_time = time()
+        deadline = start_time + timeout
+        selector = label_selector(self.labels)
+
+        # Like wait_for_snapshots, a single label selected watch tracks the claims of this run together
+        while pending:
+            response = self.core_v1.list_namespaced_persistent_volume_claim(namespace=self.namespace,
+                                                                             label_selector=selector)
+            for pvc in response.items:
+                self.update_pvc_status(pending, bound, pvc, start_time)
+
+            if not pending:
+                break
+
+            remaining = int(deadline - time())
+            if remaining <= 0:
+                raise TimeoutError(f'PVCs {", ".join(pending)} not bound after {timeout} seconds')
+
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.core_v1.list_namespaced_persistent_volume_claim,
+                                      namespace=self.namespace,
+                                      label_selector=selector,
+                                      resource_version=response.metadata.resource_version,
+                                      timeout_seconds=remaining):
+                    self.update_pvc_status(pending, bound, event['object'], start_time)
+
+                    if not pending:
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+
+        if not bound:
+            return exposes
+
+        # Only the volumes bound to this run's claims are read, by name
+        volumes = map_concurrently(self.core_v1.read_persistent_volume, bound, self.concurrency)
+        for expose in exposes.values():
+            expose.volume = volumes.get(expose.pvc_name)
+
+        return exposes
+
+    def update_pvc_status(self, pending: dict[str, tuple[str, ExposedSnapshotPvc]], bound: dict[str, str],
+                          pvc: client.V1PersistentVolumeClaim, start_time):
+        if pvc.metadata.name not in pending or pvc.status.phase != "Bound":
+            return
 
-        if server_fingerprint is not None:
-            args.append("--server-cert-fingerprint")
-            args.append(server_fingerprint)
+        name, expose = pending.pop(pvc.metadata.name)
+        bound[expose.pvc_name] = pvc.spec.volume_name
 
-        args = " ".join(args)
+        elapsed_time = time() - start_time
+        print(f"PVC {expose.pvc_name} bound after {elapsed_time:.1f} seconds")
+        if self.metrics is not None:
+            self.metrics.record_volume_bind(name, elapsed_time)
 
-        command = [
-            "bash", "-c", f"""
-                kopia repository connect server {args}\
-                && kopia snapshot create /data --override-source=/k8s/{self.namespace}/{application}/ --no-progress
-                """
-        ]
+    def waits_for_first_consumer(self, storage_class) -> bool:
+        if storage_class is None:
+            return False
+
+        if storage_class not in self.binding_modes:
+            self.binding_modes[storage_class] = self.storage_v1.read_storage_class(storage_class).volume_binding_mode
+
+        return self.binding_modes[storage_class] == "WaitForFirstConsumer"
+
+    def volume_node_affinity(self, exposes: list[ExposedSnapshotPvc]) -> client.V1Affinity | None:
+        required_terms = None
+
+        for expose in exposes:
+            volume_affinity = expose.volume.spec.node_affinity if expose.volume is not None else None
+            if volume_affinity is not None and volume_affinity.required is not None:
+                # The terms of one volume are alternatives, but every volume has to be reachable from the node
+                volume_terms = volume_affinity.required.node_selector_terms
+                required_terms = volume_terms if required_terms is None else [
+                    client.V1NodeSelectorTerm(
+                        match_expressions=self.merge_requirements(a.match_expressions, b.match_expressions),
+                        match_fields=self.merge_requirements(a.match_fields, b.match_fields))
+                    for a in required_terms for b in volume_terms]
+
+        if required_terms is None:
+            return None
+
+        return client.V1Affinity(node_affinity=client.V1NodeAffinity(
+            required_during_scheduling_ignored_during_execution=client.V1NodeSelector(
+                node_selector_terms=required_terms)))
+
+    def merge_requirements(self, a: list[client.V1NodeSelectorRequirement] | None,
+                           b: list[client.V1NodeSelectorRequirement] | None):
+        # Volumes of one storage class usually share the same topology requirement
+        merged = list(a or [])
+        merged += [requirement for requirement in b or [] if requirement not in merged]
+        return merged or None
+
+    def wait_for_pvc_bound(self, pvc_name, storage_class, timeout=3600) -> client.V1PersistentVolumeClaim | None:
+        # With WaitForFirstConsumer nothing is restored before a pod uses the claim
+        if self.waits_for_first_consumer(storage_class):
+            return None
+
+        deadline = time() + timeout
+        while True:
+            pvc = self.core_v1.read_namespaced_persistent_volume_claim(name=pvc_name, namespace=self.namespace)
+            if pvc.status.phase == "Bound":
+                return pvc
+
+            remaining = int(deadline - time())
+            if remaining <= 0:
+                raise TimeoutError(f'PVC {pvc_name} not bound after {timeout} seconds')
+
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.core_v1.list_namespaced_persistent_volume_claim,
+                                      namespace=self.namespace,
+                                      field_selector=f"metadata.name={pvc_name}",
+                                      resource_version=pvc.metadata.resource_version,
+                                      timeout_seconds=remaining):
+                    if event['object'].status.phase == "Bound":
+                        return event['object']
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+
+    def run_kopia(self, application: str, scratch_volume: str, cache_volume: str, snapshot_pvcs: dict[str, ExposedSnapshotPvc],
+                  options: KopiaOptions = None):
+        if options is None:
+            options = KopiaOptions()
+
+        options = options.sized_for([expose.snapshot.size for expose in snapshot_pvcs.values()])
+        source = f'/k8s/{self.namespace}/{application}/'
+        command = self.kopia_snapshot_command(source, f"/cache/{application}", options)
 
         if os.environ.get('SKIP_KOPIA_UPLOAD') == 'true':
             command = ["ls", "/data"]
@@ -275,33 +717,110 @@ class Backup:
                 read_only=True
             )
 
-            source = client.V1PersistentVolumeClaimVolumeSource(claim_name=expose.pvc_name, read_only=True)
-            volume = client.V1Volume(name=name, persistent_volume_claim=source)
+            claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=expose.pvc_name, read_only=True)
+            volume = client.V1Volume(name=name, persistent_volume_claim=claim)
 
             volume_mounts.append(mount)
             volumes.append(volume)
 
-        security_context = client.V1PodSecurityContext(
-            run_as_group=0,
-            run_as_user=0,
-            run_as_non_root=False,
-            seccomp_profile=client.V1SeccompProfile(type="RuntimeDefault")
-        )
+        job = self.jobs.create_job_object(f'backup-kopia', KOPIA_IMAGE, command, volume_mounts, volumes,
+                                     security_context=kopia_security_context(), env=kopia_env() + options.env(),
+                                     resources=options.resources(),
+                                     affinity=self.volume_node_affinity(list(snapshot_pvcs.values())))
+        result = KopiaSnapshotResult(source)
+        with self.limits.kopia:
+            self.jobs.run_job(job, output_parser=result)
+
+        self.record_kopia_result(application, result)
+        return result
+
+    def run_kopia_per_volume(self, application: str, scratch_volume: str, cache_volume: str,
+                             snapshot_pvcs: dict[str, ExposedSnapshotPvc], concurrency=None, options: KopiaOptions = None):
+        if options is None:
+            options = KopiaOptions()
+
+        # One job and one kopia source per volume, so hashing and uploading is spread over several pods and nodes
+        claims = {name: (name, expose.pvc_name, options.sized_for([expose.snapshot.size]),
+                         self.volume_node_affinity([expose]))
+                  for name, expose in snapshot_pvcs.items()}
+
+        if scratch_volume is not None:
+            claims["scratch"] = ("scratch", scratch_volume, options.sized_for([]), None)
+
+        return map_concurrently(lambda claim: self.run_kopia_volume(application, cache_volume, *claim),
+                                claims, concurrency or self.concurrency)
+
+    def run_kopia_volume(self, application: str, cache_volume: str, name: str, claim_name: str, options: KopiaOptions,
+                         affinity: client.V1Affinity = None):
+        # Concurrent kopia processes get their own config and cache directory on the shared cache volume
+        source = f'/k8s/{self.namespace}/{application}/{name}'
+        command = self.kopia_snapshot_command(source, f"/cache/{application}/{name}", options)
+
+        if os.environ.get('SKIP_KOPIA_UPLOAD') == 'true':
+            command = ["ls", "/data"]
+
+        volume_mounts = [
+            client.V1VolumeMount(name="cache", mount_path="/cache"),
+            client.V1VolumeMount(name="data", mount_path="/data", read_only=True),
+        ]
+
+        volumes = [
+            client.V1Volume(name="cache",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=cache_volume)),
+            client.V1Volume(name="data",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=claim_name,
+                                read_only=True)),
+        ]
+
+        job = self.jobs.create_job_object(f'backup-kopia-{name}-', KOPIA_IMAGE, command, volume_mounts, volumes,
+                                          security_context=kopia_security_context(), env=kopia_env() + options.env(),
+                                          resources=options.resources(), affinity=affinity)
+        result = KopiaSnapshotResult(source)
+        with self.limits.kopia:
+            self.jobs.run_job(job, output_parser=result)
+
+        self.record_kopia_result(name, result)
+        return result
+
+    def record_kopia_result(self, name, result: KopiaSnapshotResult):
+        print(f"Kopia snapshot {name}: {result.to_dict()}")
+        if self.metrics is not None:
+            self.metrics.record_kopia(name, result.to_dict())
+
+    def kopia_snapshot_command(self, source: str, cache_directory: str, options: KopiaOptions) -> list[str]:
+        steps = [kopia_connect_command(cache_directory, options)]
+
+        policy = options.policy_command(source)
+        if policy is not None:
+            steps.append(policy)
+
+        steps.append(f"kopia snapshot create /data --override-source={source} --no-progress {options.snapshot_args()}")
 
-        job = self.jobs.create_job_object(f'backup-kopia', image, command, volume_mounts, volumes,
-                                     security_context=security_context, env=[
-                client.V1EnvVar(name="KOPIA_PASSWORD", value=password),
-            ])
-        self.jobs.run_job(job)
+        return ["bash", "-c", " && ".join(steps)]
 
     def cleanup(self):
-        self.delete_owned_pvcs()
-        self.delete_owned_snapshots()
-        self.jobs.delete_owned_jobs()
+        # The deletions are independent: a PVC still being restored from a snapshot is protected by the snapshot
+        # controller's finalizer and a PVC still mounted by a pod by the pvc-protection finalizer
+        map_concurrently(lambda delete: delete(), {
+            "pvcs": self.delete_owned_pvcs,
+            "snapshots": self.delete_owned_snapshots,
+            "group snapshots": self.delete_owned_group_snapshots,
+            "jobs": self.jobs.delete_owned_jobs,
+        }, 4)
 
 
 class BackupContext:
-    def __init__(self, backup: Backup, postgres: PostgresBackup, scratch_volume):
+    def __init__(self, backup: Backup, postgres: PostgresBackup, scratch_volume, application=None, cache_volume=None,
+                 metrics: BackupMetrics = None):
         self.backup = backup
         self.postgres = postgres
-        self.scratch_volume = scratch_volume
\ No newline at end of file
+        self.scratch_volume = scratch_volume
+        self.application = application
+        self.cache_volume = cache_volume
+        self.metrics = metrics if metrics is not None else BackupMetrics(application, backup.namespace)
+        self.phase_durations = self.metrics.phases
+
+    def phase(self, name):
+        return self.metrics.phase(name)
\ No newline at end of file
@@ -0,0 +1,498 @@
+import copy
+import json
+import random
+import string
+import threading
+from collections import Counter
+from time import sleep, time
+from types import SimpleNamespace
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+class Latencies:
+    def __init__(self, api=0.002, snapshot_cut=0.01, snapshot_ready=0.05, pvc_bind=0.02, pod_create=0.01,
+                 pod_schedule=0.01, pod_start=0.02, job_run=0.05, log_lines=5):
+        self.api = api
+        # The driver takes the point-in-time snapshot first, the upload to the snapshot store makes it ready
+        self.snapshot_cut = snapshot_cut
+        self.snapshot_ready = snapshot_ready
+        self.pvc_bind = pvc_bind
+        self.pod_create = pod_create
+        self.pod_schedule = pod_schedule
+        self.pod_start = pod_start
+        self.job_run = job_run
+        self.log_lines = log_lines
+
+
+class FakeWatchResponse:
+    def __init__(self, api: "FakeApiServer", plural, namespace, resource_version, label_selector, field_selector,
+                 timeout_seconds):
+        self.api = api
+        self.plural = plural
+        self.namespace = namespace
+        self.resource_version = resource_version
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.deadline = time() + timeout_seconds if timeout_seconds else None
+        self.closed = False
+
+    def stream(self, amt=None, decode_content=False):
+        api = self.api
+        initial = []
+        with api.condition:
+            if self.resource_version:
+                position = next((i for i, event in enumerate(api.events) if event[0] > int(self.resource_version)),
+                                len(api.events))
+            else:
+                # Without a resource version the current state is sent as ADDED events first
+                position = len(api.events)
+                initial = api.list_objects(self.plural, self.namespace, self.label_selector, self.field_selector)
+
+        for obj in initial:
+            yield (json.dumps({"type": "ADDED", "object": obj}) + "\n").encode()
+
+        while not self.closed:
+            with api.condition:
+                while position >= len(api.events) and not self.closed:
+                    remaining = None if self.deadline is None else self.deadline - time()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    api.condition.wait(remaining if remaining is not None else 0.1)
+
+                events = api.events[position:]
+                position = len(api.events)
+
+            for _, event_type, plural, namespace, obj in events:
+                if plural == self.plural and (self.namespace is None or namespace == self.namespace) \
+                        and matches(obj, self.label_selector, self.field_selector):
+                    yield (json.dumps({"type": event_type, "object": obj}) + "\n").encode()
+
+    def close(self):
+        self.closed = True
+        with self.api.condition:
+            self.api.condition.notify_all()
+
+    def release_conn(self):
+        pass
+
+
+class FakeLogResponse:
+    def __init__(self, lines):
+        self.lines = lines
+
+    def stream(self, amt=None, decode_content=False):
+        for line in self.lines:
+            yield (line + "\n").encode()
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+# Mimics the part of kubernetes.stream.ws_client.WSClient used for exec, the command succeeds right away
+class FakeExecResponse:
+    returncode = 0
+
+    def run_forever(self, timeout=None):
+        pass
+
+    def is_open(self):
+        return False
+
+    def read_stdout(self, timeout=None):
+        return ""
+
+    def read_stderr(self, timeout=None):
+        return ""
+
+    def close(self, **kwargs):
+        pass
+
+
+# In-memory stand-in for the API server. Snapshots, PVCs, jobs and pods are driven by simulated controllers
+# with the configured latencies.
+class FakeApiServer:
+    def __init__(self, latencies: Latencies = None):
+        self.latencies = latencies or Latencies()
+        self.condition = threading.Condition()
+        self.objects: dict[tuple[str, str | None, str], dict] = {}
+        self.events: list[tuple] = []
+        self.resource_version = 0
+        self.calls = Counter()
+        self.watches = Counter()
+        self.timers: list[threading.Timer] = []
+        self.api_groups = {"snapshot.storage.k8s.io": "v1", "postgresql.cnpg.io": "v1",
+                           "groupsnapshot.storage.k8s.io": "v1beta1"}
+
+    # Seeding
+
+    def add_pvc(self, namespace, name, size="1Gi", storage_class="fake", labels=None):
+        self.store("persistentvolumeclaims", namespace, {
+            "apiVersion": "v1", "kind": "PersistentVolumeClaim",
+            "metadata": {"name": name, "namespace": namespace, "labels": labels or {}},
+            "spec": {"storageClassName": storage_class, "accessModes": ["ReadWriteOnce"],
+                     "resources": {"requests": {"storage": size}}, "volumeName": f"pv-{namespace}-{name}"},
+            "status": {"phase": "Bound"},
+        })
+        self.store("persistentvolumes", None, {
+            "apiVersion": "v1", "kind": "PersistentVolume",
+            "metadata": {"name": f"pv-{namespace}-{name}"},
+            "spec": {"capacity": {"storage": size}, "storageClassName": storage_class,
+                     "claimRef": {"namespace": namespace, "name": name},
+                     "csi": {"driver": "fake.csi.k8s.io", "volumeHandle": f"vol-{namespace}-{name}"}},
+            "status": {"phase": "Bound"},
+        })
+
+    def add_storage_class(self, name, binding_mode="Immediate"):
+        self.store("storageclasses", None, {
+            "apiVersion": "storage.k8s.io/v1", "kind": "StorageClass",
+            "metadata": {"name": name},
+            "provisioner": "fake.csi.k8s.io",
+            "volumeBindingMode": binding_mode,
+        })
+
+    def add_deployment(self, namespace, name, replicas=1):
+        labels = {"app": name}
+        self.store("deployments", namespace, {
+            "apiVersion": "apps/v1", "kind": "Deployment",
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {"replicas": replicas, "selector": {"matchLabels": labels},
+                     "template": {"metadata": {"labels": labels}, "spec": {"containers": []}}},
+        })
+        for i in range(replicas):
+            self.store("pods", namespace, {
+                "apiVersion": "v1", "kind": "Pod",
+                "metadata": {"name": f"{name}-{i}", "namespace": namespace, "labels": labels},
+                "spec": {"containers": [{"name": "app"}]},
+                "status": {"phase": "Running", "conditions": [{"type": "Ready", "status": "True"}]},
+            })
+
+    def add_postgres_cluster(self, namespace, name, instances=1):
+        self.store("clusters", namespace, {
+            "apiVersion": "postgresql.cnpg.io/v1", "kind": "Cluster",
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {"instances": instances},
+            "status": {"image": "ghcr.io/cloudnative-pg/postgresql:17"},
+        })
+
+    def close(self):
+        for timer in self.timers:
+            timer.cancel()
+
+    # Store
+
+    def store(self, plural, namespace, obj, event_type="ADDED"):
+        with self.condition:
+            self.resource_version += 1
+            obj["metadata"]["resourceVersion"] = str(self.resource_version)
+            obj["metadata"].setdefault("uid", f"uid-{self.resource_version}")
+            obj["metadata"].setdefault("creationTimestamp", "2026-01-01T00:00:00Z")
+            self.objects[(plural, namespace, obj["metadata"]["name"])] = obj
+            self.events.append((self.resource_version, event_type, plural, namespace, copy.deepcopy(obj)))
+            self.condition.notify_all()
+            return copy.deepcopy(obj)
+
+    def delete(self, plural, namespace, name):
+        with self.condition:
+            obj = self.objects.pop((plural, namespace, name), None)
+            if obj is None:
+                return None
+            self.resource_version += 1
+            self.events.append((self.resource_version, "DELETED", plural, namespace, copy.deepcopy(obj)))
+            self.condition.notify_all()
+            return obj
+
+    def update(self, plural, namespace, name, change):
+        with self.condition:
+            obj = self.objects.get((plural, namespace, name))
+            if obj is None:
+                return None
+            change(obj)
+            return self.store(plural, namespace, obj, "MODIFIED")
+
+    def list_objects(self, plural, namespace, label_selector=None, field_selector=None):
+        with self.condition:
+            return [copy.deepcopy(obj) for (p, ns, _), obj in sorted(self.objects.items(), key=lambda i: i[0][2])
+                    if p == plural and (namespace is None or ns == namespace)
+                    and matches(obj, label_selector, field_selector)]
+
+    def later(self, delay, fn, *args):
+        timer = threading.Timer(delay, fn, args)
+        timer.daemon = True
+        self.timers.append(timer)
+        timer.start()
+
+    # Request handling
+
+    def request(self, method, resource_path, path_params, query, body, preload_content):
+        self.calls[f"{method} {resource_path}"] += 1
+
+        if self.latencies.api:
+            sleep(self.latencies.api)
+
+        path = resource_path
+        for key, value in path_params.items():
+            path = path.replace("{" + key + "}", str(value))
+
+        if path.rstrip("/") == "/apis":
+            return {"kind": "APIGroupList", "apiVersion": "v1", "groups": [
+                {"name": api_group, "versions": [{"groupVersion": f"{api_group}/{version}", "version": version}],
+                 "preferredVersion": {"groupVersion": f"{api_group}/{version}", "version": version}}
+                for api_group, version in self.api_groups.items()]}
+
+        plural, namespace, name, subresource = parse_path(path)
+
+        if query.get("watch"):
+            self.watches[plural] += 1
+            return FakeWatchResponse(self, plural, namespace, query.get("resourceVersion"),
+                                     query.get("labelSelector"), query.get("fieldSelector"),
+                                     query.get("timeoutSeconds"))
+
+        if subresource == "log":
+            if query.get("follow"):
+                self.watches["log"] += 1
+            lines = [f"{name}: line {i}" for i in range(self.latencies.log_lines)]
+            if not preload_content:
+                return FakeLogResponse(lines)
+            return "\n".join(lines)
+
+        if subresource == "exec":
+            if not preload_content:
+                return FakeExecResponse()
+            return ""
+
+        return self.handle(method, plural, namespace, name, query, body)
+
+    def handle(self, method, plural, namespace, name, query, body):
+        label_selector = query.get("labelSelector")
+        field_selector = query.get("fieldSelector")
+
+        if method == "GET" and name is None:
+            with self.condition:
+                items = self.list_objects(plural, namespace, label_selector, field_selector)
+                return {"metadata": {"resourceVersion": str(self.resource_version)}, "items": items}
+
+        if method == "GET":
+            obj = self.objects.get((plural, namespace, name))
+            if obj is None:
+                raise ApiException(status=404, reason=f"{plural} {name} not found")
+            return copy.deepcopy(obj)
+
+        if method == "POST":
+            metadata = body.setdefault("metadata", {})
+            if "name" not in metadata:
+                metadata["name"] = metadata["generateName"] + "".join(random.choices(string.ascii_lowercase, k=5))
+            metadata["namespace"] = namespace
+            if (plural, namespace, metadata["name"]) in self.objects:
+                raise ApiException(status=409, reason=f"{plural} {metadata['name']} already exists")
+            obj = self.store(plural, namespace, body)
+            self.on_created(plural, namespace, obj)
+            return obj
+
+        if method in ("PUT", "PATCH"):
+            def change(obj):
+                if method == "PATCH":
+                    merge(obj, body)
+                    return
+
+                if body["metadata"].get("resourceVersion") not in (None, obj["metadata"]["resourceVersion"]):
+                    raise ApiException(status=409, reason=f"{plural} {name} was modified")
+                obj.clear()
+                obj.update(body)
+            obj = self.update(plural, namespace, name, change)
+            if obj is None:
+                raise ApiException(status=404, reason=f"{plural} {name} not found")
+            return obj
+
+        if method == "DELETE" and name is None:
+            deleted = [self.delete(plural, namespace, obj["metadata"]["name"])
+                       for obj in self.list_objects(plural, namespace, label_selector, field_selector)]
+            return {"metadata": {}, "items": deleted}
+
+        if method == "DELETE":
+            obj = self.delete(plural, namespace, name)
+            if obj is None:
+                raise ApiException(status=404, reason=f"{plural} {name} not found")
+            return obj
+
+        raise ApiException(status=405, reason=f"{method} not supported on {plural}")
+
+    # Simulated controllers
+
+    def on_created(self, plural, namespace, obj):
+        name = obj["metadata"]["name"]
+
+        if plural == "volumesnapshots":
+            source = self.objects.get(("persistentvolumeclaims", namespace,
+                                       obj["spec"]["source"]["persistentVolumeClaimName"]))
+            size = source["spec"]["resources"]["requests"]["storage"] if source else "1Gi"
+            self.later(self.latencies.snapshot_cut, self.update, plural, namespace, name,
+                       lambda o: o.update(status={"readyToUse": False, "creationTime": "2026-01-01T00:00:00Z"}))
+            self.later(self.latencies.snapshot_ready, self.update, plural, namespace, name,
+                       lambda o: o.update(status={"readyToUse": True, "restoreSize": size,
+                                                  "creationTime": "2026-01-01T00:00:00Z"}))
+        elif plural == "volumegroupsnapshots":
+            self.later(self.latencies.snapshot_cut, self.update, plural, namespace, name,
+                       lambda o: o.update(status={"readyToUse": False, "creationTime": "2026-01-01T00:00:00Z"}))
+            self.later(self.latencies.snapshot_ready, self.cut_group_snapshot, namespace, obj)
+        elif plural == "persistentvolumeclaims":
+            self.update(plural, namespace, name, lambda o: o.update(status={"phase": "Pending"}))
+            self.later(self.latencies.pvc_bind, self.bind_pvc, namespace, name)
+        elif plural == "jobs":
+            self.later(self.latencies.pod_create, self.create_job_pod, namespace, obj)
+
+    def cut_group_snapshot(self, namespace, group_snapshot):
+        name = group_snapshot["metadata"]["name"]
+        selector = ",".join(f"{k}={v}" for k, v in group_snapshot["spec"]["source"]["selector"]["matchLabels"].items())
+
+        pairs = []
+        for pvc in self.list_objects("persistentvolumeclaims", namespace, selector):
+            volume = self.objects[("persistentvolumes", None, pvc["spec"]["volumeName"])]
+            member = f"{name}-{pvc['metadata']['name']}"
+            pairs.append({"volumeHandle": volume["spec"]["csi"]["volumeHandle"], "snapshotHandle": f"snap-{member}"})
+
+            self.store("volumesnapshotcontents", None, {
+                "apiVersion": "snapshot.storage.k8s.io/v1", "kind": "VolumeSnapshotContent",
+                "metadata": {"name": f"content-{member}"},
+                "spec": {"source": {"snapshotHandle": f"snap-{member}"}},
+                "status": {"snapshotHandle": f"snap-{member}", "readyToUse": True},
+            })
+            self.store("volumesnapshots", namespace, {
+                "apiVersion": "snapshot.storage.k8s.io/v1", "kind": "VolumeSnapshot",
+                "metadata": {"name": member, "namespace": namespace},
+                "spec": {"source": {"volumeSnapshotContentName": f"content-{member}"}},
+                "status": {"readyToUse": True, "restoreSize": pvc["spec"]["resources"]["requests"]["storage"],
+                           "volumeGroupSnapshotName": name, "boundVolumeSnapshotContentName": f"content-{member}"},
+            })
+
+        self.store("volumegroupsnapshotcontents", None, {
+            "apiVersion": "groupsnapshot.storage.k8s.io/v1beta1", "kind": "VolumeGroupSnapshotContent",
+            "metadata": {"name": f"content-{name}"},
+            "status": {"readyToUse": True, "volumeSnapshotHandlePairList": pairs},
+        })
+        self.update("volumegroupsnapshots", namespace, name, lambda o: o.update(
+            status={"readyToUse": True, "creationTime": "2026-01-01T00:00:00Z",
+                    "boundVolumeGroupSnapshotContentName": f"content-{name}"}))
+
+    def bind_pvc(self, namespace, name):
+        pvc = self.objects[("persistentvolumeclaims", namespace, name)]
+        self.store("persistentvolumes", None, {
+            "apiVersion": "v1", "kind": "PersistentVolume",
+            "metadata": {"name": f"pv-{name}"},
+            "spec": {"capacity": pvc["spec"]["resources"]["requests"], "storageClassName": pvc["spec"]["storageClassName"],
+                     "claimRef": {"namespace": namespace, "name": name},
+                     "csi": {"driver": "fake.csi.k8s.io", "volumeHandle": f"vol-{namespace}-{name}"},
+                     "nodeAffinity": {"required": {"nodeSelectorTerms": [{"matchExpressions": [
+                         {"key": "topology.kubernetes.io/zone", "operator": "In", "values": ["zone-a"]}]}]}}},
+            "status": {"phase": "Bound"},
+        })
+
+        def bind(o):
+            o["spec"]["volumeName"] = f"pv-{name}"
+            o["status"] = {"phase": "Bound"}
+        self.update("persistentvolumeclaims", namespace, name, bind)
+
+    def create_job_pod(self, namespace, job):
+        job_name = job["metadata"]["name"]
+        template = job["spec"]["template"]
+        labels = dict(template.get("metadata", {}).get("labels") or {})
+        labels["job-name"] = job_name
+        pod_name = job_name + "-" + "".join(random.choices(string.ascii_lowercase, k=5))
+
+        self.store("pods", namespace, {
+            "apiVersion": "v1", "kind": "Pod",
+            "metadata": {"name": pod_name, "namespace": namespace, "labels": labels},
+            "spec": template["spec"],
+            "status": {"phase": "Pending"},
+        })
+
+        latencies = self.latencies
+        self.later(latencies.pod_schedule, self.update, "pods", namespace, pod_name,
+                   lambda o: o["status"].update(conditions=[{"type": "PodScheduled", "status": "True"}]))
+        self.later(latencies.pod_schedule + latencies.pod_start, self.update, "pods", namespace, pod_name,
+                   lambda o: o["status"].update(phase="Running"))
+        self.later(latencies.pod_schedule + latencies.pod_start + latencies.job_run,
+                   self.finish_job, namespace, job_name, pod_name)
+
+    def finish_job(self, namespace, job_name, pod_name):
+        self.update("pods", namespace, pod_name, lambda o: o["status"].update(phase="Succeeded"))
+        self.update("jobs", namespace, job_name, lambda o: o.update(status={"succeeded": 1}))
+
+
+
+# Answers the generated API classes at the call_api level from a FakeApiServer, so the request and watch
+# handling of the real client is bypassed while (de)serialization of the models stays the same.
+class FakeApiClient(client.ApiClient):
+    def __init__(self, server: FakeApiServer):
+        super().__init__()
+        self.server = server
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, body=None,
+                 post_params=None, files=None, response_type=None, auth_settings=None, async_req=None,
+                 _return_http_data_only=None, collection_formats=None, _preload_content=True,
+                 _request_timeout=None, _host=None, _request_auth=None):
+        data = self.server.request(method, resource_path, path_params or {}, dict(query_params or []),
+                                   self.sanitize_for_serialization(body) if body is not None else None,
+                                   _preload_content)
+
+        if not isinstance(data, dict):
+            return data
+
+        if response_type is None:
+            return None
+
+        return self.deserialize(SimpleNamespace(data=json.dumps(data)), response_type)
+
+def parse_path(path):
+    parts = path.strip("/").split("/")
+    # /api/v1/... or /apis/<group>/<version>/...
+    parts = parts[2:] if parts[0] == "api" else parts[3:]
+
+    namespace = None
+    if parts and parts[0] == "namespaces" and len(parts) > 2:
+        namespace = parts[1]
+        parts = parts[2:]
+
+    plural = parts[0]
+    name = parts[1] if len(parts) > 1 else None
+    subresource = parts[2] if len(parts) > 2 else None
+
+    return plural, namespace, name, subresource
+
+
+def matches(obj, label_selector, field_selector):
+    labels = obj["metadata"].get("labels") or {}
+    for requirement in filter(None, (label_selector or "").split(",")):
+        if "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.replace("==", "=").split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif requirement not in labels:
+            return False
+
+    for requirement in filter(None, (field_selector or "").split(",")):
+        key, value = requirement.split("=", 1)
+        current = obj
+        for part in key.split("."):
+            current = current.get(part) if isinstance(current, dict) else None
+        if current != value:
+            return False
+
+    return True
+
+
+def merge(target: dict, change: dict):
+    for key, value in change.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
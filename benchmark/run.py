@@ -0,0 +1,110 @@
+import argparse
+import contextlib
+import io
+import os
+from time import time
+
+from backup import BackupContext, SnapshotInfo
+from benchmark.fake_api import FakeApiClient, FakeApiServer, Latencies
+from main import BackupDefinition, create_backups
+
+SCENARIOS = [
+    # (applications, volumes per application)
+    (1, 1),
+    (1, 10),
+    (1, 100),
+    (5, 10),
+]
+
+
+class BenchmarkDefinition(BackupDefinition):
+    def __init__(self, application, volumes, per_volume, group):
+        self.app = application
+        self.volumes = volumes
+        self.per_volume = per_volume
+        self.group = group
+
+    def quiesce(self, ctx: BackupContext):
+        ctx.backup.exec_in_single_deployment_pod(self.app, ["true"])
+
+    def capture(self, ctx: BackupContext) -> dict[str, SnapshotInfo]:
+        return ctx.backup.create_snapshots({f"vol{i}": f"{self.app}-vol{i}" for i in range(self.volumes)},
+                                           group_selector={"backup": self.app} if self.group else None)
+
+    def release(self, ctx: BackupContext):
+        ctx.backup.exec_in_single_deployment_pod(self.app, ["true"])
+
+    def dump(self, ctx: BackupContext):
+        ctx.postgres.dump_postgres_clusters([f"pg-{self.app}"], scratch_volume=ctx.scratch_volume)
+
+    def scratch_volume(self) -> str | None:
+        return f"{self.app}-scratch"
+
+    def cache_volume(self) -> str | None:
+        return f"{self.app}-cache"
+
+    def application(self) -> str | None:
+        return self.app
+
+    def namespace(self) -> str | None:
+        return self.app
+
+    def per_volume_snapshots(self) -> bool:
+        return self.per_volume
+
+
+def seed(api: FakeApiServer, namespace, application, volumes):
+    api.add_storage_class("fake")
+    api.add_deployment(namespace, application)
+    api.add_postgres_cluster(namespace, f"pg-{application}")
+    api.add_pvc(namespace, f"{application}-scratch")
+    api.add_pvc(namespace, f"{application}-cache")
+    for i in range(volumes):
+        api.add_pvc(namespace, f"{application}-vol{i}", size=f"{i + 1}Gi", labels={"backup": application})
+
+
+def run_scenario(applications, volumes, latencies: Latencies, per_volume=False, group=False) -> dict:
+    server = FakeApiServer(latencies)
+    names = [f"app{i}" for i in range(applications)]
+    for name in names:
+        seed(server, name, name, volumes)
+
+    start_time = time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_backups([BenchmarkDefinition(name, volumes, per_volume, group) for name in names],
+                       max_applications=applications, api_client=FakeApiClient(server))
+    elapsed_time = time() - start_time
+
+    server.close()
+
+    return {
+        "applications": applications,
+        "volumes": volumes,
+        "seconds": elapsed_time,
+        "api_calls": sum(server.calls.values()),
+        "watches": sum(server.watches.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run create_backup against a fake Kubernetes API")
+    parser.add_argument("--api-latency", type=float, default=0.002, help="seconds per API request")
+    parser.add_argument("--snapshot-ready", type=float, default=0.05, help="seconds until a snapshot is ready")
+    parser.add_argument("--job-run", type=float, default=0.05, help="seconds a job pod runs")
+    parser.add_argument("--per-volume", action="store_true", help="run one kopia job per volume")
+    parser.add_argument("--group", action="store_true", help="use one VolumeGroupSnapshot per application")
+    args = parser.parse_args()
+
+    os.environ.setdefault("REPOSITORY_URL", "https://kopia.invalid:51515")
+
+    latencies = Latencies(api=args.api_latency, snapshot_ready=args.snapshot_ready, job_run=args.job_run)
+
+    print(f"{'apps':>5} {'volumes':>8} {'seconds':>9} {'api calls':>10} {'watches':>8}")
+    for applications, volumes in SCENARIOS:
+        result = run_scenario(applications, volumes, latencies, args.per_volume, args.group)
+        print(f"{result['applications']:>5} {result['volumes']:>8} {result['seconds']:>9.2f} "
+              f"{result['api_calls']:>10} {result['watches']:>8}")
+
+
+if __name__ == "__main__":
+    main()
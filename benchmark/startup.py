@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import time
+
+# Modules each CLI command imports before it can do anything
+COMMANDS = {
+    "backup": "main",
+    "restore": "restore",
+    "controller": "controller",
+    "gc": "garbage",
+}
+
+# Runs in a fresh interpreter: imports the command, loads an in-cluster config and lists PVCs from a local server
+CHILD = """
+import importlib, json, os, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"apiVersion": "v1", "kind": "PersistentVolumeClaimList",
+                           "metadata": {"resourceVersion": "1"}, "items": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+port = server.server_address[1]
+
+directory = tempfile.mkdtemp()
+for name in ["token", "ca.crt"]:
+    with open(os.path.join(directory, name), "w") as f:
+        f.write("benchmark")
+
+start_time = time.perf_counter()
+import cli
+importlib.import_module(sys.argv[1])
+import_time = time.perf_counter()
+
+from kubernetes import client
+from kubernetes.config.incluster_config import InClusterConfigLoader
+
+configuration = client.Configuration()
+# Without the token refresh hook, which would reset the host to HTTPS before every request
+InClusterConfigLoader(os.path.join(directory, "token"), os.path.join(directory, "ca.crt"), try_refresh_token=False,
+                      environ={"KUBERNETES_SERVICE_HOST": "127.0.0.1",
+                               "KUBERNETES_SERVICE_PORT": str(port)}).load_and_set(configuration)
+config_time = time.perf_counter()
+
+# The local server speaks plain HTTP
+configuration.host = f"http://127.0.0.1:{port}"
+with client.ApiClient(configuration) as api_client:
+    client.CoreV1Api(api_client).list_namespaced_persistent_volume_claim("default")
+call_time = time.perf_counter()
+
+print(json.dumps({"import": import_time - start_time, "config": config_time - import_time,
+                  "first call": call_time - config_time}))
+"""
+
+
+def run_once(module, env) -> dict:
+    start_time = time()
+    output = subprocess.run([sys.executable, "-c", CHILD, module], env=env, check=True, capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    result = json.loads(output)
+    result["total"] = time() - start_time
+
+    return result
+
+
+def run_scenario(module, bytecode: bool, runs) -> dict:
+    env = dict(os.environ)
+
+    with tempfile.TemporaryDirectory() as empty:
+        if bytecode:
+            # Like the image, where every module was compiled at build time
+            run_once(module, env)
+        else:
+            # Nothing to load and nothing written, every run compiles every module again
+            env["PYTHONDONTWRITEBYTECODE"] = "1"
+            env["PYTHONPYCACHEPREFIX"] = empty
+
+        results = [run_once(module, env) for _ in range(runs)]
+
+    return {key: statistics.median(result[key] for result in results) for key in results[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup of the CLI commands in a fresh interpreter")
+    parser.add_argument("--runs", type=int, default=3, help="runs per command, the median is reported")
+    parser.add_argument("--no-bytecode", action="store_true", help="also measure without compiled bytecode")
+    args = parser.parse_args()
+
+    modes = [True, False] if args.no_bytecode else [True]
+
+    print(f"{'command':>10} {'bytecode':>9} {'import':>8} {'config':>8} {'1st call':>9} {'total':>8}")
+    for command, module in COMMANDS.items():
+        for bytecode in modes:
+            result = run_scenario(module, bytecode, args.runs)
+            print(f"{command:>10} {'yes' if bytecode else 'no':>9} {result['import']:>8.3f} {result['config']:>8.3f} "
+                  f"{result['first call']:>9.3f} {result['total']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
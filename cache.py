@@ -0,0 +1,121 @@
+import threading
+
+from kubernetes import client
+from kubernetes.watch import watch
+
+from labels import label_selector
+from parallel import map_concurrently
+
+
+def name_of(obj) -> str:
+    return obj['metadata']['name'] if isinstance(obj, dict) else obj.metadata.name
+
+
+def resource_version_of(obj) -> str:
+    return obj['metadata']['resourceVersion'] if isinstance(obj, dict) else obj.metadata.resource_version
+
+
+def labels_of(obj) -> dict[str, str]:
+    return (obj['metadata'].get('labels') if isinstance(obj, dict) else obj.metadata.labels) or {}
+
+
+# Read-through cache of the namespace. Each kind is filled by one list call on first use, so repeated lookups
+# don't go to the API server again. A single backup run is short enough to work from that list. Long-lived caches,
+# like the controller's, keep each kind current with a watch, and a watch that fails drops its kind, which makes
+# the next lookup list again.
+# A label selector limits every kind to the matching objects on the API server already.
+class ResourceCache:
+    def __init__(self, api_client, namespace, watch=False, watch_timeout=60, selector: dict[str, str] = None):
+        core_v1 = client.CoreV1Api(api_client)
+        apps_v1 = client.AppsV1Api(api_client)
+        custom_api = client.CustomObjectsApi(api_client)
+        self.namespace = namespace
+        self.watching = watch
+        self.watch_timeout = watch_timeout
+        self.lock = threading.Lock()
+        self.stores: dict[str, dict] = {}
+        self.stopped = threading.Event()
+
+        # The generated methods themselves, watch.Watch reads the response type from their docstring
+        self.sources = {
+            "deployments": (apps_v1.list_namespaced_deployment, {"namespace": namespace}),
+            "pods": (core_v1.list_namespaced_pod, {"namespace": namespace}),
+            "persistentvolumeclaims": (core_v1.list_namespaced_persistent_volume_claim, {"namespace": namespace}),
+            "configmaps": (core_v1.list_namespaced_config_map, {"namespace": namespace}),
+            "clusters": (custom_api.list_namespaced_custom_object, {"group": "postgresql.cnpg.io", "version": "v1",
+                                                                    "namespace": namespace, "plural": "clusters"}),
+        }
+
+        if selector:
+            for func, kwargs in self.sources.values():
+                kwargs["label_selector"] = label_selector(selector)
+
+    def prefetch(self, kinds: list[str]):
+        # The lists run side by side, so filling the cache costs a single round trip
+        map_concurrently(self.store, {kind: kind for kind in kinds}, len(kinds))
+
+    def get(self, kind, name):
+        store = self.store(kind)
+        with self.lock:
+            return store.get(name)
+
+    def list(self, kind, selector: dict[str, str] = None) -> list:
+        store = self.store(kind)
+        with self.lock:
+            items = list(store.values())
+
+        return [obj for obj in items
+                if all(labels_of(obj).get(key) == value for key, value in (selector or {}).items())]
+
+    def store(self, kind) -> dict:
+        with self.lock:
+            store = self.stores.get(kind)
+        if store is not None:
+            return store
+
+        func, kwargs = self.sources[kind]
+        response = func(**kwargs)
+        if isinstance(response, dict):
+            items, resource_version = response['items'], response['metadata']['resourceVersion']
+        else:
+            items, resource_version = response.items, response.metadata.resource_version
+
+        listed = {name_of(obj): obj for obj in items}
+        with self.lock:
+            # Another thread might have listed the same kind in the meantime
+            store = self.stores.setdefault(kind, listed)
+
+        if store is listed and self.watching:
+            threading.Thread(target=self.watch, args=(kind, store, resource_version), daemon=True).start()
+
+        return store
+
+    def watch(self, kind, store: dict, resource_version):
+        func, kwargs = self.sources[kind]
+
+        while not self.stopped.is_set():
+            w = watch.Watch()
+            try:
+                for event in w.stream(func, resource_version=resource_version, timeout_seconds=self.watch_timeout,
+                                      **kwargs):
+                    if self.stopped.is_set():
+                        return
+
+                    obj = event['object']
+                    resource_version = resource_version_of(obj)
+                    with self.lock:
+                        if event['type'] == 'DELETED':
+                            store.pop(name_of(obj), None)
+                        else:
+                            store[name_of(obj)] = obj
+            except Exception as e:
+                print(f"Watch of {kind} failed, listing them again on next use: {e}")
+                with self.lock:
+                    if self.stores.get(kind) is store:
+                        del self.stores[kind]
+                return
+            finally:
+                w.stop()
+
+    def close(self):
+        self.stopped.set()
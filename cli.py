@@ -0,0 +1,78 @@
+import argparse
+import runpy
+
+# Every command imports what it needs when it runs, e.g. the garbage collector never loads the backup phases
+
+
+def load_definition(path):
+    # The file defines the application like the chart does, ending with e.g. `definition = MyBackup()`
+    return runpy.run_path(path)["definition"]
+
+
+def backup(args):
+    from main import create_backup, create_backups
+
+    # Several definitions are backed up side by side, sharing the limits and a resource cache per namespace
+    if len(args.definition) == 1:
+        create_backup(load_definition(args.definition[0]))
+    else:
+        create_backups([load_definition(path) for path in args.definition])
+
+
+def plan(args):
+    import json
+
+    from plan import plan_backup
+
+    print(json.dumps(plan_backup(load_definition(args.definition)).to_dict(), indent=2))
+
+
+def restore(args):
+    from restore import restore_backup
+
+    restore_backup(load_definition(args.definition))
+
+
+def controller(args):
+    from controller import run_controller
+
+    run_controller(args.namespace)
+
+
+def gc(args):
+    from garbage import collect_garbage
+
+    collect_garbage(args.namespace)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="k8s-backup", description="Back up Kubernetes applications with kopia")
+    commands = parser.add_subparsers(required=True)
+
+    command = commands.add_parser("backup", help="run a backup")
+    command.add_argument("definition", nargs="+",
+                         help="Python files assigning the definition to `definition`, one per application")
+    command.set_defaults(func=backup)
+
+    for name, func, summary in [("plan", plan, "print what a backup would do without changing anything"),
+                                 ("restore", restore, "restore volumes and Postgres clusters")]:
+        command = commands.add_parser(name, help=summary)
+        command.add_argument("definition", help="Python file assigning the definition to `definition`")
+        command.set_defaults(func=func)
+
+    command = commands.add_parser("controller", help="run scheduled backups from ConfigMaps")
+    command.add_argument("--namespace", action="append",
+                         help="namespace to watch for definitions, may be repeated, defaults to the namespace of the "
+                              "service account")
+    command.set_defaults(func=controller)
+
+    command = commands.add_parser("gc", help="delete resources left behind by killed runs")
+    command.add_argument("--namespace", help="defaults to the namespace of the service account")
+    command.set_defaults(func=gc)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
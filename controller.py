@@ -0,0 +1,200 @@
+import json
+import os
+import textwrap
+import threading
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from backup import BackupContext, SnapshotInfo
+from cache import ResourceCache
+from cron import CronSchedule
+from labels import BACKUP_DEFINITION_LABEL
+from limits import BackupLimits
+from main import BackupDefinition, create_backup, get_current_namespace
+from repository import KopiaOptions
+
+# ConfigMap keys holding the body of a BackupDefinition method, as in the chart's phases
+PHASE_KEYS = {
+    "prepareSnapshots": "prepare_snapshots",
+    "quiesce": "quiesce",
+    "capture": "capture",
+    "release": "release",
+    "dump": "dump",
+    "changeHints": "change_hints",
+}
+
+
+def compile_phase(name, code):
+    source = f"def {name}(self, ctx):\n" + textwrap.indent(code, "    ")
+    scope = {"BackupContext": BackupContext, "SnapshotInfo": SnapshotInfo}
+    exec(compile(source, f"<{name}>", "exec"), scope)
+    return scope[name]
+
+
+# A BackupDefinition read from a ConfigMap labeled flx5.backup/definition=true. The phases are Python code just like
+# in the chart and run with the controller's permissions. That is why the controller only reads definitions from
+# the namespaces it was explicitly given, where writing ConfigMaps has to be limited to whoever may run backups.
+class ConfigMapDefinition(BackupDefinition):
+    def __init__(self, config_map: client.V1ConfigMap):
+        self.name = config_map.metadata.name
+        self.config_map_namespace = config_map.metadata.namespace
+        self.data = config_map.data or {}
+
+        for key, method in PHASE_KEYS.items():
+            if self.data.get(key):
+                setattr(self, method, types.MethodType(compile_phase(method, self.data[key]), self))
+
+    def flag(self, key) -> bool:
+        return self.data.get(key, "false").lower() == "true"
+
+    def ready_before_release(self) -> bool:
+        return self.flag("readyBeforeRelease")
+
+    def scratch_volume(self) -> str | None:
+        return self.data.get("scratchVolume") or None
+
+    def cache_volume(self) -> str | None:
+        return self.data.get("cacheVolume") or None
+
+    def application(self) -> str | None:
+        return self.data.get("application") or self.name
+
+    def namespace(self) -> str | None:
+        return self.data.get("namespace") or self.config_map_namespace
+
+    def per_volume_snapshots(self) -> bool:
+        return self.flag("perVolumeSnapshots")
+
+    def incremental(self) -> bool:
+        return self.flag("incremental")
+
+    def verify_percent(self) -> float | None:
+        value = self.data.get("verifyPercent")
+        return float(value) if value else None
+
+    def kopia_options(self) -> KopiaOptions:
+        # The KopiaOptions constructor arguments as JSON, e.g. {"compression": "zstd"}
+        return KopiaOptions(**json.loads(self.data.get("kopia") or "{}"))
+
+
+# Resident alternative to one Helm Job per backup: definitions and their schedules are read from ConfigMaps
+# through a watched cache, and runs share one ApiClient, the limits and a resource cache per namespace.
+# Definitions are watched in the given namespaces only, the chart creates them next to the application.
+class BackupController:
+    def __init__(self, api_client, namespaces: list[str], limits: BackupLimits = None, max_applications=4,
+                 interval=20):
+        self.api_client = api_client
+        self.namespaces = namespaces
+        self.core_v1 = client.CoreV1Api(api_client)
+        # Only the labeled ConfigMaps are listed and watched
+        self.definitions = [ResourceCache(api_client, namespace, watch=True,
+                                          selector={BACKUP_DEFINITION_LABEL: "true"})
+                            for namespace in namespaces]
+        self.limits = limits if limits is not None else \
+            BackupLimits.from_environment(api_client, snapshots=8, dumps=2, kopia=2)
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=max_applications)
+        self.lock = threading.Lock()
+        self.caches: dict[str, ResourceCache] = {}
+        self.running: dict[str, Future] = {}
+        self.last_started: dict[str, datetime] = {}
+
+    def run_forever(self, stop: threading.Event = None):
+        stop = stop if stop is not None else threading.Event()
+        print(f"Watching backup definitions in namespaces {', '.join(self.namespaces)}")
+
+        try:
+            while not stop.is_set():
+                self.tick(datetime.now(timezone.utc))
+                stop.wait(self.interval)
+        finally:
+            self.executor.shutdown(wait=True)
+            for cache in self.definitions:
+                cache.close()
+            for cache in self.caches.values():
+                cache.close()
+
+    def tick(self, now: datetime):
+        # Schedules are evaluated in UTC, at most one run per definition and minute
+        minute = now.replace(second=0, microsecond=0)
+
+        config_maps = [config_map for cache in self.definitions
+                       for config_map in cache.list("configmaps", {BACKUP_DEFINITION_LABEL: "true"})]
+
+        for config_map in config_maps:
+            # Definitions of the same name may exist in several namespaces
+            name = f"{config_map.metadata.namespace}/{config_map.metadata.name}"
+            schedule = (config_map.data or {}).get("schedule")
+            if not schedule or self.last_started.get(name) == minute:
+                continue
+
+            running = self.running.get(name)
+            if running is not None and not running.done():
+                continue
+
+            try:
+                if not CronSchedule(schedule).matches(minute):
+                    continue
+                definition = ConfigMapDefinition(config_map)
+            except Exception as e:
+                print(f"Backup definition {name} is invalid: {e}")
+                continue
+
+            self.last_started[name] = minute
+            self.running[name] = self.executor.submit(self.run, name, definition)
+
+    def run(self, name, definition: ConfigMapDefinition):
+        print(f"Starting scheduled backup {name}")
+        start_time = datetime.now(timezone.utc)
+
+        try:
+            create_backup(definition, self.api_client, definition.namespace(), self.limits,
+                          cache=self.cache_for(definition.namespace()))
+            result = "success"
+        except Exception as e:
+            print(f"Scheduled backup {name} failed: {e}")
+            result = f"failure: {e}"[:1024]
+
+        self.record_result(definition, start_time, result)
+
+    def cache_for(self, namespace) -> ResourceCache:
+        with self.lock:
+            if namespace not in self.caches:
+                self.caches[namespace] = ResourceCache(self.api_client, namespace, watch=True)
+
+            return self.caches[namespace]
+
+    def record_result(self, definition: ConfigMapDefinition, start_time: datetime, result):
+        try:
+            self.core_v1.patch_namespaced_config_map(definition.name, definition.config_map_namespace,
+                                                     {"metadata": {"annotations": {
+                "flx5.backup/last-run": start_time.isoformat(),
+                "flx5.backup/last-result": result,
+            }}})
+        except ApiException as e:
+            print(f"Failed to record the result of backup {definition.name}: {e.reason}")
+
+
+def run_controller(namespaces: list[str] = None, api_client=None):
+    if api_client is None:
+        configuration = config.load_incluster_config()
+
+        with client.ApiClient(configuration) as api_client:
+            return run_controller(namespaces, api_client)
+
+    if not namespaces:
+        # BACKUP_CONTROLLER_NAMESPACES=nextcloud,gitea, unset only watches the controller's own namespace
+        namespaces = [namespace.strip() for namespace
+                      in os.environ.get("BACKUP_CONTROLLER_NAMESPACES", "").split(",") if namespace.strip()] \
+                     or [get_current_namespace()]
+
+    max_applications = int(os.environ.get("BACKUP_MAX_APPLICATIONS", "4"))
+    BackupController(api_client, namespaces, max_applications=max_applications).run_forever()
+
+
+if __name__ == "__main__":
+    run_controller()
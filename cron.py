@@ -0,0 +1,56 @@
+from datetime import datetime
+
+
+def parse_field(field: str, minimum: int, maximum: int) -> set[int]:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+
+        if part == "*":
+            start, end = minimum, maximum
+        elif "-" in part:
+            start, end = map(int, part.split("-", 1))
+        else:
+            # "5/15" means every 15 starting at 5
+            start = int(part)
+            end = start if step == 1 else maximum
+
+        if start < minimum or end > maximum or start > end:
+            raise ValueError(f'{field} is out of range {minimum}-{maximum}')
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+# The five field cron syntax (minute, hour, day of month, month, day of week) with lists, ranges and steps
+class CronSchedule:
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression "{expression}" does not have five fields')
+
+        self.minutes = parse_field(fields[0], 0, 59)
+        self.hours = parse_field(fields[1], 0, 23)
+        self.days = parse_field(fields[2], 1, 31)
+        self.months = parse_field(fields[3], 1, 12)
+        # 0 and 7 are both Sunday
+        self.weekdays = {weekday % 7 for weekday in parse_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def matches(self, moment: datetime) -> bool:
+        if moment.minute not in self.minutes or moment.hour not in self.hours or moment.month not in self.months:
+            return False
+
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+
+        # As in cron, a restricted day of month and day of week are alternatives
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
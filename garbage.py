@@ -0,0 +1,100 @@
+import os
+from datetime import datetime, timezone, timedelta
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from labels import BACKUP_OWNER_LABEL
+from main import get_current_namespace
+from parallel import map_concurrently
+
+
+# Removes what backup runs left behind when they were killed before their cleanup ran: every resource carrying
+# the owner label which is older than the TTL. The TTL has to be longer than the longest backup run.
+class GarbageCollector:
+    def __init__(self, api_client, namespace, ttl=86400, concurrency=8):
+        self.client = api_client
+        self.core_v1 = client.CoreV1Api(api_client)
+        self.batch_v1 = client.BatchV1Api(api_client)
+        self.custom_api = client.CustomObjectsApi(api_client)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.concurrency = concurrency
+
+    def collect(self) -> dict[str, list[str]]:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+
+        stale = {}
+        for pvc in self.core_v1.list_namespaced_persistent_volume_claim(
+                namespace=self.namespace, label_selector=BACKUP_OWNER_LABEL).items:
+            if pvc.metadata.creation_timestamp < cutoff:
+                stale[f"pvc/{pvc.metadata.name}"] = lambda name=pvc.metadata.name: \
+                    self.core_v1.delete_namespaced_persistent_volume_claim(name, self.namespace)
+
+        for job in self.batch_v1.list_namespaced_job(namespace=self.namespace, label_selector=BACKUP_OWNER_LABEL).items:
+            if job.metadata.creation_timestamp < cutoff:
+                stale[f"job/{job.metadata.name}"] = lambda name=job.metadata.name: \
+                    self.batch_v1.delete_namespaced_job(name, self.namespace, propagation_policy='Background')
+
+        custom_resources = [("snapshot.storage.k8s.io", "v1", "volumesnapshots")]
+        group_snapshot_version = self.get_group_snapshot_version()
+        if group_snapshot_version is not None:
+            custom_resources.append(("groupsnapshot.storage.k8s.io", group_snapshot_version, "volumegroupsnapshots"))
+
+        for group, version, plural in custom_resources:
+            objects = self.custom_api.list_namespaced_custom_object(group=group, version=version,
+                                                                    namespace=self.namespace, plural=plural,
+                                                                    label_selector=BACKUP_OWNER_LABEL)
+            for obj in objects['items']:
+                name = obj['metadata']['name']
+                created = datetime.fromisoformat(obj['metadata']['creationTimestamp'].replace("Z", "+00:00"))
+                if created < cutoff:
+                    stale[f"{plural}/{name}"] = lambda group=group, version=version, plural=plural, name=name: \
+                        self.custom_api.delete_namespaced_custom_object(group=group, version=version,
+                                                                        namespace=self.namespace, plural=plural,
+                                                                        name=name)
+
+        map_concurrently(self.delete, stale, self.concurrency)
+
+        deleted = {}
+        for key in stale:
+            kind, name = key.split("/", 1)
+            deleted.setdefault(kind, []).append(name)
+            print(f"Deleted stale {kind} {name}")
+
+        return deleted
+
+    def delete(self, delete):
+        try:
+            delete()
+        except ApiException as e:
+            # Already gone, e.g. a member snapshot removed together with its group
+            if e.status != 404:
+                raise
+
+    def get_group_snapshot_version(self) -> str | None:
+        for api_group in client.ApisApi(self.client).get_api_versions().groups:
+            if api_group.name == "groupsnapshot.storage.k8s.io":
+                return api_group.preferred_version.version
+
+        return None
+
+
+def collect_garbage(namespace=None, ttl=None, api_client=None) -> dict[str, list[str]]:
+    if api_client is None:
+        configuration = config.load_incluster_config()
+
+        with client.ApiClient(configuration) as api_client:
+            return collect_garbage(namespace, ttl, api_client)
+
+    if namespace is None:
+        namespace = get_current_namespace()
+
+    if ttl is None:
+        ttl = int(os.environ.get("BACKUP_GC_TTL", "86400"))
+
+    return GarbageCollector(api_client, namespace, ttl).collect()
+
+
+if __name__ == "__main__":
+    collect_garbage()
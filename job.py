@@ -1,30 +1,63 @@
-from time import sleep, time
+import os
+import threading
+from collections import deque
+from time import time
 from typing import List
 
 from kubernetes import client
-from kubernetes.client import V1Job, CoreV1Api
+from kubernetes.client import V1Job, V1Pod, CoreV1Api
+from kubernetes.client.rest import ApiException
 from kubernetes.watch import watch
 
-from labels import BACKUP_OWNER_LABEL
+from labels import backup_labels, label_selector
+from metrics import BackupMetrics
+
+# Waiting reasons a container does not recover from without changes to the job
+TERMINAL_WAITING_REASONS = {
+    "ImagePullBackOff",
+    "ErrImageNeverPull",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "CreateContainerError",
+}
+
+
+# Kept in memory per job for the error message of a failed job
+LOG_TAIL_LINES = 50
+LOG_LINE_LENGTH = 4096
 
 
 class BackupJob:
-    def __init__(self, api_client, owner, namespace):
+    def __init__(self, api_client, owner, namespace, scheduling_timeout=None, metrics: BackupMetrics = None,
+                 run_id=None):
         self.client = api_client
         self.batch_v1 = client.BatchV1Api(api_client)
         self.core_v1: CoreV1Api = client.CoreV1Api(api_client)
         self.owner = owner
         self.namespace = namespace
+        self.labels = backup_labels(owner, run_id)
+
+        if scheduling_timeout is None:
+            scheduling_timeout = int(os.environ.get("JOB_SCHEDULING_TIMEOUT", "600"))
+
+        self.scheduling_timeout = scheduling_timeout
+        self.max_log_lines = int(os.environ.get("JOB_LOG_MAX_LINES", "10000"))
+        self.pod_timings: dict[str, dict[str, float]] = {}
+        self.metrics = metrics
 
     def create_job_object(self, name: str, image: str, command: List[str],
                           mounts: List[client.V1VolumeMount],
-                          volumes: List[client.V1Volume], env, security_context = None) -> client.V1Job:
+                          volumes: List[client.V1Volume], env, security_context = None,
+                          init_containers: List[client.V1Container] = None,
+                          resources: client.V1ResourceRequirements = None,
+                          affinity: client.V1Affinity = None) -> client.V1Job:
         # Configure Pod template container
         container = client.V1Container(
             name="container",
             image=image,
             command=command,
             volume_mounts=mounts,
+            resources=resources,
         env=env)
 
         if security_context is None:
@@ -40,15 +73,15 @@ class BackupJob:
         # Create and configure a spec section
         template = client.V1PodTemplateSpec(
             metadata=client.V1ObjectMeta(
-                labels={
-                    BACKUP_OWNER_LABEL: self.owner
-                }
+                labels=self.labels
             ),
             spec=client.V1PodSpec(
                 restart_policy="Never",
                 containers=[container],
+                init_containers=init_containers,
                 volumes=volumes,
-                security_context=security_context
+                security_context=security_context,
+                affinity=affinity
             )
         )
         # Create the specification of deployment
@@ -59,13 +92,13 @@ class BackupJob:
         job = client.V1Job(
             api_version="batch/v1",
             kind="Job",
-            metadata=client.V1ObjectMeta(generate_name=name),
+            metadata=client.V1ObjectMeta(generate_name=name, labels=self.labels),
             spec=spec)
 
         return job
 
 
-    def run_job(self, job):
+    def run_job(self, job, output_parser=None):
         job: V1Job = self.batch_v1.create_namespaced_job(
             body=job,
             namespace=self.namespace)
@@ -73,54 +106,166 @@ class BackupJob:
         print(f'Executing job {job.metadata.name}')
         start_time = time()
 
-        print("Waiting for Pod to initialize...")
-        pod_name = None
-        while True:
-            pods = self.core_v1.list_namespaced_pod(namespace=self.namespace, label_selector=f"job-name={job.metadata.name}")
-            if pods.items:
-                pod = pods.items[0]
-                pod_name = pod.metadata.name
-                # Wait until the Pod is no longer 'Pending'
-                if pod.status.phase != "Pending":
-                    break
-            sleep(1)
-
-        # 4. Stream the logs to stdout
+        pod_name = self.wait_for_pod(job)
+
+        # The logs are followed next to the job status watch, so a failed job ends the wait immediately
+        log_tail = deque(maxlen=LOG_TAIL_LINES)
+        logs = threading.Thread(target=self.follow_logs, args=(pod_name, output_parser, log_tail), daemon=True)
+        logs.start()
+
+        try:
+            obj = self.wait_for_job(job)
+        finally:
+            # Once the job finished the container is gone and the log stream ends by itself
+            logs.join(timeout=10)
+
+        elapsed_time = time() - start_time
+        print(f"Job {job.metadata.name} finished in {elapsed_time} seconds")
+
+        if self.metrics is not None:
+            timings = dict(self.pod_timings.get(job.metadata.name, {}))
+            timings["total"] = elapsed_time
+            self.metrics.record_job((job.metadata.generate_name or job.metadata.name).rstrip("-"), timings)
+
+        if obj.status.failed is not None:
+            raise Exception(f'Job {job.metadata.name} failed, last log lines:\n' + "\n".join(log_tail))
+
+    def follow_logs(self, pod_name, output_parser, log_tail: deque):
         print(f"Streaming logs from Pod '{pod_name}':\n" + "-" * 30)
+        printed = 0
+
         w = watch.Watch()
         try:
             for line in w.stream(self.core_v1.read_namespaced_pod_log, name=pod_name, namespace=self.namespace, follow=True):
-                print(line)
+                if output_parser is not None:
+                    output_parser.feed(line)
+
+                log_tail.append(line[:LOG_LINE_LENGTH])
+
+                # Chatty jobs only print up to max_log_lines, the tail is still kept for error messages
+                if printed < self.max_log_lines:
+                    print(line[:LOG_LINE_LENGTH])
+                elif printed == self.max_log_lines:
+                    print(f"Suppressing further log lines of {pod_name}")
+                printed += 1
+        except Exception as e:
+            print(f"Log stream of {pod_name} ended: {e}")
         finally:
             w.stop()
 
-        print("Logs ended")
-        w = watch.Watch()
+        print(f"Logs ended after {printed} lines")
 
-        # Stream events for pods in the given namespace
-        # Use v1.list_pod_for_all_namespaces for cluster-wide watching
-        selector = "metadata.name="+job.metadata.name
+    def wait_for_job(self, job: V1Job) -> V1Job:
+        resource_version = job.metadata.resource_version
 
-        for event in w.stream(self.batch_v1.list_namespaced_job,
-                              resource_version=job.metadata.resource_version,
-                              field_selector=selector,
-                              namespace=self.namespace):
-            obj = event['object']
+        while True:
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.batch_v1.list_namespaced_job,
+                                      resource_version=resource_version,
+                                      field_selector="metadata.name=" + job.metadata.name,
+                                      namespace=self.namespace):
+                    obj = event['object']
+                    resource_version = obj.metadata.resource_version
 
-            if obj.status.succeeded is not None or \
-                    obj.status.failed is not None:
+                    if obj.status.succeeded is not None or \
+                            obj.status.failed is not None:
+                        return obj
+            except ApiException as e:
+                # 410 Gone: continue from the current state of the job
+                if e.status != 410:
+                    raise
+                obj = self.batch_v1.read_namespaced_job(job.metadata.name, self.namespace)
+                if obj.status.succeeded is not None or obj.status.failed is not None:
+                    return obj
+                resource_version = obj.metadata.resource_version
+            finally:
                 w.stop()
-                end_time = time()
 
-                elapsed_time = end_time - start_time
-                print(f"Job {job.metadata.name} finished in {elapsed_time} seconds")
+    def wait_for_pod(self, job: V1Job) -> str:
+        print("Waiting for Pod to initialize...")
+        start_time = time()
+        deadline = start_time + self.scheduling_timeout
+        scheduled_time = None
+        unschedulable = None
+        resource_version = job.metadata.resource_version
+
+        # The pod is created after the job, so watching from the job's resource version sees it being added
+        while True:
+            remaining = int(deadline - time())
+            if remaining <= 0:
+                message = f'Pod of job {job.metadata.name} not started after {self.scheduling_timeout} seconds'
+                if unschedulable is not None:
+                    message += f': {unschedulable}'
+                raise TimeoutError(message)
+
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.core_v1.list_namespaced_pod,
+                                      namespace=self.namespace,
+                                      label_selector=f"job-name={job.metadata.name}",
+                                      resource_version=resource_version,
+                                      timeout_seconds=remaining):
+                    pod: V1Pod = event['object']
+                    resource_version = pod.metadata.resource_version
+
+                    if event['type'] == 'DELETED':
+                        continue
+
+                    condition = self.get_pod_condition(pod, "PodScheduled")
+                    if scheduled_time is None and condition is not None:
+                        if condition.status == "True":
+                            scheduled_time = time()
+                            print(f"Pod {pod.metadata.name} scheduled after {scheduled_time - start_time:.1f} seconds")
+                        elif condition.reason == "Unschedulable" and unschedulable != condition.message:
+                            # The cluster autoscaler might still make room, so only the timeout aborts
+                            unschedulable = condition.message
+                            print(f"Pod {pod.metadata.name} unschedulable: {unschedulable}")
+
+                    reason = self.get_terminal_waiting_reason(pod)
+                    if reason is not None:
+                        raise Exception(f'Pod {pod.metadata.name} of job {job.metadata.name} failed to start: {reason}')
+
+                    if pod.status.phase != "Pending":
+                        started_time = time()
+                        if scheduled_time is None:
+                            scheduled_time = started_time
+
+                        self.pod_timings[job.metadata.name] = {
+                            "scheduling": scheduled_time - start_time,
+                            "startup": started_time - scheduled_time,
+                        }
+                        print(f"Pod {pod.metadata.name} started after {started_time - start_time:.1f} seconds "
+                              f"(pulling and creating containers took {started_time - scheduled_time:.1f} seconds)")
+                        return pod.metadata.name
+            except ApiException as e:
+                # 410 Gone: the resource version is too old, start over with the current state
+                if e.status != 410:
+                    raise
+                resource_version = None
+            finally:
+                w.stop()
+
+    def get_pod_condition(self, pod: V1Pod, condition_type: str):
+        for condition in pod.status.conditions or []:
+            if condition.type == condition_type:
+                return condition
+
+        return None
+
+    def get_terminal_waiting_reason(self, pod: V1Pod) -> str | None:
+        statuses = (pod.status.init_container_statuses or []) + (pod.status.container_statuses or [])
+        for status in statuses:
+            waiting = status.state.waiting if status.state is not None else None
+            if waiting is not None and waiting.reason in TERMINAL_WAITING_REASONS:
+                return f'{waiting.reason}: {waiting.message}'
 
-                if obj.status.failed is not None:
-                    raise Exception(f'Job {job.metadata.name} failed')
+        return None
 
     def delete_owned_jobs(self):
+        # Background propagation returns right away, the garbage collector removes the pods afterwards
         self.batch_v1.delete_collection_namespaced_job(
             namespace=self.namespace,
-            label_selector=f'{BACKUP_OWNER_LABEL}={self.owner}',
-            propagation_policy='Foreground'
+            label_selector=label_selector(self.labels),
+            propagation_policy='Background'
         )
\ No newline at end of file
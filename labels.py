@@ -1 +1,17 @@
-BACKUP_OWNER_LABEL = "flx5.backup/owner"
\ No newline at end of file
+BACKUP_OWNER_LABEL = "flx5.backup/owner"
+BACKUP_RUN_LABEL = "flx5.backup/run"
+BACKUP_DEFINITION_LABEL = "flx5.backup/definition"
+# Restored PVCs are not owned by a run, neither the cleanup nor the garbage collector may delete them
+BACKUP_RESTORED_FROM_LABEL = "flx5.backup/restored-from"
+
+
+def backup_labels(owner, run_id=None) -> dict[str, str]:
+    labels = {BACKUP_OWNER_LABEL: owner}
+    if run_id is not None:
+        labels[BACKUP_RUN_LABEL] = run_id
+
+    return labels
+
+
+def label_selector(labels: dict[str, str]) -> str:
+    return ",".join([f"{k}={v}" for k, v in labels.items()])
@@ -0,0 +1,121 @@
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from time import sleep, time
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+# A counting semaphore shared between pods: the slots are the Leases <name>-0 .. <name>-<limit - 1>,
+# a slot is held by renewing its Lease and given back by clearing the holder
+class LeaseSemaphore:
+    def __init__(self, api_client, namespace, name, limit, lease_duration=60):
+        self.coordination_v1 = client.CoordinationV1Api(api_client)
+        self.namespace = namespace
+        self.name = name
+        self.limit = limit
+        self.lease_duration = lease_duration
+
+    @contextmanager
+    def slot(self, timeout=3600):
+        identity = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        lease_name = self.acquire(identity, timeout)
+
+        stop = threading.Event()
+        renewal = threading.Thread(target=self.renew, args=(lease_name, identity, stop), daemon=True)
+        renewal.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewal.join()
+            self.release(lease_name, identity)
+
+    def acquire(self, identity, timeout) -> str:
+        deadline = time() + timeout
+        delay = 1
+
+        while True:
+            for i in range(self.limit):
+                lease_name = f"{self.name}-{i}"
+                if self.try_acquire(lease_name, identity):
+                    return lease_name
+
+            if time() > deadline:
+                raise TimeoutError(f'No free lease {self.name} after {timeout} seconds')
+
+            sleep(delay)
+            delay = min(delay * 2, 10)
+
+    def try_acquire(self, lease_name, identity) -> bool:
+        now = datetime.now(timezone.utc)
+
+        try:
+            lease = self.coordination_v1.read_namespaced_lease(lease_name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=lease_name),
+                spec=self.lease_spec(identity, now, 0))
+            try:
+                self.coordination_v1.create_namespaced_lease(self.namespace, lease)
+                return True
+            except ApiException as e:
+                if e.status == 409:
+                    return False
+                raise
+
+        spec = lease.spec
+        expired = spec.renew_time is None or \
+            spec.renew_time + timedelta(seconds=spec.lease_duration_seconds or self.lease_duration) < now
+        if spec.holder_identity and not expired:
+            return False
+
+        # The resource version in the metadata makes this fail if another pod took the lease in the meantime
+        lease.spec = self.lease_spec(identity, now, (spec.lease_transitions or 0) + 1)
+        try:
+            self.coordination_v1.replace_namespaced_lease(lease_name, self.namespace, lease)
+            return True
+        except ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+
+    def renew(self, lease_name, identity, stop: threading.Event):
+        while not stop.wait(self.lease_duration / 3):
+            try:
+                lease = self.coordination_v1.read_namespaced_lease(lease_name, self.namespace)
+                if lease.spec.holder_identity != identity:
+                    print(f"Lost lease {lease_name}")
+                    return
+
+                lease.spec.renew_time = datetime.now(timezone.utc)
+                self.coordination_v1.replace_namespaced_lease(lease_name, self.namespace, lease)
+            except ApiException as e:
+                print(f"Failed to renew lease {lease_name}: {e.reason}")
+
+    def release(self, lease_name, identity):
+        try:
+            lease = self.coordination_v1.read_namespaced_lease(lease_name, self.namespace)
+            if lease.spec.holder_identity != identity:
+                return
+
+            lease.spec.holder_identity = None
+            lease.spec.renew_time = None
+            self.coordination_v1.replace_namespaced_lease(lease_name, self.namespace, lease)
+        except ApiException as e:
+            # An unreleased lease expires after its duration anyway
+            print(f"Failed to release lease {lease_name}: {e.reason}")
+
+    def lease_spec(self, identity, now, transitions) -> client.V1LeaseSpec:
+        return client.V1LeaseSpec(
+            holder_identity=identity,
+            lease_duration_seconds=self.lease_duration,
+            acquire_time=now,
+            renew_time=now,
+            lease_transitions=transitions)
@@ -0,0 +1,77 @@
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+
+from lease import LeaseSemaphore
+
+
+def bounded(limit: int | None):
+    if not limit:
+        return nullcontext()
+
+    return threading.BoundedSemaphore(limit)
+
+
+def optional_int(name, default=None) -> int | None:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+# Caps the CSI operations (snapshot create calls and clone restores) in flight per storage class. The cap holds within
+# this process and, with a lease namespace, across every backup pod using the same Leases.
+class StorageClassLimiter:
+    def __init__(self, limits: dict[str, int] = None, api_client=None, lease_namespace=None):
+        self.limits = limits or {}
+        self.api_client = api_client
+        self.lease_namespace = lease_namespace
+        self.lock = threading.Lock()
+        self.semaphores: dict[str, threading.BoundedSemaphore] = {}
+
+    def throttled(self, storage_class) -> bool:
+        return bool(self.limits.get(storage_class))
+
+    @contextmanager
+    def slot(self, storage_class):
+        if not self.throttled(storage_class):
+            yield
+            return
+
+        limit = self.limits[storage_class]
+        with self.lock:
+            semaphore = self.semaphores.setdefault(storage_class, threading.BoundedSemaphore(limit))
+
+        with semaphore:
+            if self.lease_namespace is None:
+                yield
+                return
+
+            leases = LeaseSemaphore(self.api_client, self.lease_namespace, f"backup-csi-{storage_class}", limit)
+            with leases.slot():
+                yield
+
+
+# Shared by every application of a run, so the global number of snapshot creations, dump jobs and kopia
+# uploads stays bounded no matter how many applications are backed up at once
+class BackupLimits:
+    def __init__(self, snapshots: int | None = None, dumps: int | None = None, kopia: int | None = None,
+                 storage_classes: StorageClassLimiter = None):
+        self.snapshots = bounded(snapshots)
+        self.dumps = bounded(dumps)
+        self.kopia = bounded(kopia)
+        self.storage_classes = storage_classes if storage_classes is not None else StorageClassLimiter()
+
+    @staticmethod
+    def from_environment(api_client, snapshots=None, dumps=None, kopia=None) -> "BackupLimits":
+        # BACKUP_STORAGE_CLASS_LIMITS=rook-ceph-block=4,rook-cephfs=2
+        storage_class_limits = {}
+        for entry in filter(None, os.environ.get("BACKUP_STORAGE_CLASS_LIMITS", "").split(",")):
+            storage_class, limit = entry.split("=", 1)
+            storage_class_limits[storage_class.strip()] = int(limit)
+
+        return BackupLimits(
+            snapshots=optional_int("BACKUP_MAX_SNAPSHOTS", snapshots),
+            dumps=optional_int("BACKUP_MAX_DUMPS", dumps),
+            kopia=optional_int("BACKUP_MAX_KOPIA", kopia),
+            storage_classes=StorageClassLimiter(storage_class_limits, api_client,
+                                                os.environ.get("BACKUP_LEASE_NAMESPACE")),
+        )
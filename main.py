@@ -1,15 +1,88 @@
+import copy
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
 
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
 
 from backup import Backup, SnapshotInfo, BackupContext
+from cache import ResourceCache
+from limits import BackupLimits
+from metrics import BackupMetrics
 from postgres import PostgresBackup
+from repository import KopiaOptions
+from state import BackupHistoryStore, VolumeState, VolumeStateStore
+from verify import verify_backup
 
 
 class BackupDefinition:
     def prepare_snapshots(self, ctx: BackupContext) -> dict[str, SnapshotInfo]:
+        # Snapshots are crash consistent as soon as the driver cut them, so the application is released before
+        # they are ready and before any dumps run. Only drivers which need readyToUse keep it quiesced longer.
+        quiesce_start = time()
+        try:
+            with ctx.phase("quiesce"):
+                self.quiesce(ctx)
+
+            with ctx.phase("snapshot create"):
+                snapshots = self.capture(ctx)
+
+            # Still quiesced, so the hints describe exactly what the snapshots contain
+            for name, change_hint in self.change_hints(ctx).items():
+                snapshots[name].change_hint = change_hint
+
+            if self.ready_before_release():
+                with ctx.phase("ready wait"):
+                    ctx.backup.wait_for_snapshots(snapshots)
+            else:
+                # capture only created the snapshot objects, the driver takes the snapshots asynchronously
+                with ctx.phase("snapshot cut"):
+                    ctx.backup.wait_for_snapshots(snapshots, cut_only=True)
+        finally:
+            with ctx.phase("release"):
+                self.release(ctx)
+
+            ctx.metrics.record_phase("downtime", time() - quiesce_start)
+            print(f"Application was quiesced for {ctx.phase_durations['downtime']:.1f} seconds")
+
+        with ctx.phase("dump"):
+            self.dump(ctx)
+
+        if not self.ready_before_release():
+            with ctx.phase("ready wait"):
+                ctx.backup.wait_for_snapshots(snapshots)
+
+        return snapshots
+
+    def quiesce(self, ctx: BackupContext):
         pass
 
+    def capture(self, ctx: BackupContext) -> dict[str, SnapshotInfo]:
+        return {}
+
+    def release(self, ctx: BackupContext):
+        pass
+
+    def dump(self, ctx: BackupContext):
+        pass
+
+    def ready_before_release(self) -> bool:
+        return False
+
+    def change_hints(self, ctx: BackupContext) -> dict[str, str]:
+        # e.g. the application version for a volume which only changes on upgrades
+        return {}
+
+    def incremental(self) -> bool:
+        return False
+
+    def verify_percent(self) -> float | None:
+        # Percentage of the files kopia reads back after the upload, None skips the verification
+        return None
+
     def scratch_volume(self) -> str | None:
         return None
 
@@ -19,6 +92,15 @@ class BackupDefinition:
     def application(self) -> str | None:
         pass
 
+    def namespace(self) -> str | None:
+        return None
+
+    def per_volume_snapshots(self) -> bool:
+        return False
+
+    def kopia_options(self) -> KopiaOptions:
+        return KopiaOptions()
+
 def get_current_namespace() -> str:
     ns_path = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
     if os.path.exists(ns_path):
@@ -27,21 +109,189 @@ def get_current_namespace() -> str:
 
     return "default"
 
-def create_backup(definition: BackupDefinition):
-    # Configs can be set in Configuration class directly or using helper utility
-    configuration = config.load_incluster_config()
+def create_backup(definition: BackupDefinition, api_client=None, namespace=None, limits: BackupLimits = None,
+                  cache: ResourceCache = None, verify=True):
+    if api_client is None:
+        # Configs can be set in Configuration class directly or using helper utility
+        configuration = config.load_incluster_config()
+
+        # Enter a context with an instance of the API kubernetes.client
+        with client.ApiClient(configuration) as api_client:
+            return create_backup(definition, api_client, namespace, limits, cache, verify)
+
+    if namespace is None:
+        namespace = definition.namespace() or get_current_namespace()
+
+    if limits is None:
+        limits = BackupLimits.from_environment(api_client)
+
+    # A shallow copy shares configuration and connection pool, but gets its own instrumented call_api
+    api_client = copy.copy(api_client)
+
+    scratch_volume = definition.scratch_volume()  # TODO Ensure scratch is cleaned?
+    application = definition.application()
+
+    concurrency = int(os.environ.get("BACKUP_CONCURRENCY", "8"))
+
+    metrics = BackupMetrics(application, namespace)
+    metrics.instrument(api_client)
+
+    run_id = uuid.uuid4().hex[:12]
 
-    # Enter a context with an instance of the API kubernetes.client
-    with client.ApiClient(configuration) as api_client:
-        namespace = get_current_namespace()
-        scratch_volume = definition.scratch_volume()  # TODO Ensure scratch is cleaned?
-        application = definition.application()
+    # A cache handed in, e.g. by the controller, outlives the run
+    owns_cache = cache is None
+    if owns_cache:
+        cache = ResourceCache(api_client, namespace)
+    backup = Backup(api_client, application, namespace, concurrency=concurrency, metrics=metrics, limits=limits,
+                    run_id=run_id, cache=cache)
+    postgres = PostgresBackup(api_client, application, namespace, metrics=metrics, limits=limits, run_id=run_id,
+                              cache=cache, jobs=backup.jobs)
 
-        backup = Backup(api_client, application, namespace)
-        postgres = PostgresBackup(api_client, application, namespace)
+    ctx = BackupContext(backup, postgres, scratch_volume, application, definition.cache_volume(), metrics=metrics)
+    try:
+        # Postgres clusters are left out, their CRD might not be installed
+        cache.prefetch(["deployments", "pods", "persistentvolumeclaims"])
 
-        ctx = BackupContext(backup, postgres, scratch_volume)
         snapshots = definition.prepare_snapshots(ctx)
-        exposes = backup.expose_snapshots(snapshots)
-        backup.run_kopia(application, scratch_volume, definition.cache_volume(), exposes)
-        backup.cleanup()
+
+        for name, snapshot in snapshots.items():
+            metrics.record_snapshot(name, snapshot.size)
+
+        states = None
+        if definition.incremental():
+            if definition.per_volume_snapshots():
+                states = VolumeStateStore(api_client, application, namespace)
+                snapshots = skip_unchanged_volumes(states, snapshots)
+            else:
+                # A single kopia source has to contain every volume, skipping one would drop it from the snapshot
+                print("Incremental backups require per volume snapshots, backing up every volume")
+
+        with ctx.phase("expose"):
+            exposes = backup.expose_snapshots(snapshots)
+
+        with ctx.phase("bind"):
+            backup.wait_for_exposed_pvcs(exposes)
+
+        with ctx.phase("kopia"):
+            if definition.per_volume_snapshots():
+                backup.run_kopia_per_volume(application, scratch_volume, definition.cache_volume(), exposes,
+                                            options=definition.kopia_options())
+            else:
+                backup.run_kopia(application, scratch_volume, definition.cache_volume(), exposes,
+                                 options=definition.kopia_options())
+
+        if states is not None:
+            now = datetime.now(timezone.utc)
+            states.save({name: VolumeState(snapshot.name, snapshot.size, snapshot.change_hint, now)
+                         for name, snapshot in snapshots.items()})
+
+        metrics.finish(True)
+    except BaseException:
+        metrics.finish(False)
+        raise
+    finally:
+        # Failed runs are cleaned up as well, anything left behind is removed by the garbage collector
+        with ctx.phase("cleanup"):
+            try:
+                backup.cleanup()
+            except Exception as e:
+                print(f"Cleanup of run {run_id} failed: {e}")
+
+        if owns_cache:
+            cache.close()
+
+        if metrics.success:
+            try:
+                BackupHistoryStore(api_client, application, namespace).save(metrics.summary())
+            except ApiException as e:
+                print(f"Failed to save the summary of run {run_id}: {e.reason}")
+        write_metrics(metrics)
+
+    # create_backups verifies on its own, while the next application is being backed up
+    if verify and definition.verify_percent() is not None:
+        with ctx.phase("verify"):
+            verify_backup(definition, metrics.summary(), api_client)
+        write_metrics(metrics)
+
+    return metrics
+
+
+def skip_unchanged_volumes(states: VolumeStateStore, snapshots: dict[str, SnapshotInfo]) -> dict[str, SnapshotInfo]:
+    previous = states.load()
+
+    changed = {}
+    for name, snapshot in snapshots.items():
+        if states.is_unchanged(previous.get(name), snapshot.size, snapshot.change_hint):
+            print(f"Volume {name} is unchanged since {previous[name].backed_up_at.isoformat()}, skipping it")
+        else:
+            changed[name] = snapshot
+
+    return changed
+
+
+def create_backups(definitions: list[BackupDefinition], limits: BackupLimits = None, max_applications=4,
+                   api_client=None) -> dict[str, BackupMetrics]:
+    if api_client is None:
+        configuration = config.load_incluster_config()
+
+        with client.ApiClient(configuration) as api_client:
+            return create_backups(definitions, limits, max_applications, api_client)
+
+    if limits is None:
+        limits = BackupLimits.from_environment(api_client, snapshots=8, dumps=2, kopia=2)
+
+    # Every application is backed up on its own thread, the limits are shared between all of them.
+    # Applications of one namespace share a watched resource cache like in the controller, an application alone in
+    # its namespace lists what it needs itself. A failed application does not stop the others.
+    namespaces = [definition.namespace() or get_current_namespace() for definition in definitions]
+    caches = {namespace: ResourceCache(api_client, namespace, watch=True)
+              for namespace in set(namespaces) if namespaces.count(namespace) > 1}
+
+    results: dict[str, BackupMetrics] = {}
+    failures: dict[str, BaseException] = {}
+    workers = max(1, min(max_applications, len(definitions)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+                ThreadPoolExecutor(max_workers=workers) as verifications:
+            runs = {f"{namespace}/{definition.application()}":
+                        (definition, executor.submit(create_backup, definition, api_client, namespace, limits,
+                                                     caches.get(namespace), False))
+                    for definition, namespace in zip(definitions, namespaces)}
+
+            # A finished application is verified on a pool of its own, off the path of the remaining backups
+            checks = {}
+            for name, (definition, run) in runs.items():
+                try:
+                    results[name] = run.result()
+                except Exception as e:
+                    print(f"Backup of {name} failed: {e}")
+                    failures[name] = e
+                    continue
+
+                if definition.verify_percent() is not None:
+                    checks[name] = verifications.submit(verify_backup, definition, results[name].summary(), api_client)
+
+            for name, check in checks.items():
+                try:
+                    check.result()
+                except Exception as e:
+                    print(f"Verification of {name} failed: {e}")
+                    failures[name] = e
+    finally:
+        for cache in caches.values():
+            cache.close()
+
+    if failures:
+        raise Exception(f'Backups of {", ".join(failures)} failed')
+
+    return results
+
+
+def write_metrics(metrics: BackupMetrics):
+    json_path = os.environ.get("BACKUP_METRICS_FILE")
+    if json_path:
+        metrics.write_json(json_path)
+
+    prometheus_path = os.environ.get("BACKUP_METRICS_PROMETHEUS_FILE")
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
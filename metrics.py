@@ -0,0 +1,149 @@
+import json
+import threading
+from contextlib import contextmanager
+from time import time
+
+from kubernetes.utils import parse_quantity
+
+
+class BackupMetrics:
+    def __init__(self, application, namespace):
+        self.application = application
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.start_time = time()
+        self.end_time = None
+        self.success = None
+        self.phases: dict[str, float] = {}
+        self.snapshot_sizes: dict[str, int] = {}
+        self.volume_binds: dict[str, float] = {}
+        self.jobs: dict[str, dict[str, float]] = {}
+        self.kopia: dict[str, dict] = {}
+        self.dumps: dict[str, str] = {}
+        self.api_calls: dict[str, dict[str, float]] = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time()
+        try:
+            yield
+        finally:
+            elapsed_time = time() - start_time
+            self.record_phase(name, elapsed_time)
+            print(f"Phase {name} finished in {elapsed_time:.1f} seconds")
+
+    def record_phase(self, name, seconds: float):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def record_snapshot(self, name, size):
+        if size is None:
+            return
+
+        with self.lock:
+            self.snapshot_sizes[name] = int(parse_quantity(size))
+
+    def record_volume_bind(self, name, seconds: float):
+        with self.lock:
+            self.volume_binds[name] = seconds
+
+    def record_job(self, name, timings: dict[str, float]):
+        with self.lock:
+            self.jobs[name] = timings
+
+    def record_kopia(self, name, result: dict):
+        with self.lock:
+            self.kopia[name] = result
+
+    def record_dump(self, name, path):
+        with self.lock:
+            self.dumps[name] = path
+
+    def record_api_call(self, call, seconds: float):
+        with self.lock:
+            stats = self.api_calls.setdefault(call, {"count": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+
+    def instrument(self, api_client):
+        # Every request of the generated API classes goes through call_api, watches included
+        call_api = api_client.call_api
+
+        def timed_call_api(resource_path, method, *args, **kwargs):
+            start_time = time()
+            try:
+                return call_api(resource_path, method, *args, **kwargs)
+            finally:
+                self.record_api_call(f"{method} {resource_path}", time() - start_time)
+
+        api_client.call_api = timed_call_api
+
+    def finish(self, success: bool):
+        self.end_time = time()
+        self.success = success
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "application": self.application,
+                "namespace": self.namespace,
+                "start_time": self.start_time,
+                "end_time": self.end_time,
+                "duration": (self.end_time or time()) - self.start_time,
+                "success": self.success,
+                "phases": dict(self.phases),
+                "snapshot_sizes": dict(self.snapshot_sizes),
+                "volume_binds": dict(self.volume_binds),
+                "jobs": {name: dict(timings) for name, timings in self.jobs.items()},
+                "kopia": {name: dict(result) for name, result in self.kopia.items()},
+                "dumps": dict(self.dumps),
+                "api_calls": {call: dict(stats) for call, stats in self.api_calls.items()},
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        # Text exposition format as accepted by the Prometheus Pushgateway
+        summary = self.summary()
+        labels = f'application="{self.application}",namespace="{self.namespace}"'
+
+        lines = [
+            "# TYPE backup_duration_seconds gauge",
+            f"backup_duration_seconds{{{labels}}} {summary['duration']}",
+            "# TYPE backup_success gauge",
+            f"backup_success{{{labels}}} {1 if summary['success'] else 0}",
+            "# TYPE backup_phase_duration_seconds gauge",
+        ]
+        lines += [f'backup_phase_duration_seconds{{{labels},phase="{phase}"}} {seconds}'
+                  for phase, seconds in summary["phases"].items()]
+
+        lines.append("# TYPE backup_snapshot_size_bytes gauge")
+        lines += [f'backup_snapshot_size_bytes{{{labels},volume="{volume}"}} {size}'
+                  for volume, size in summary["snapshot_sizes"].items()]
+
+        lines.append("# TYPE backup_volume_bind_seconds gauge")
+        lines += [f'backup_volume_bind_seconds{{{labels},volume="{volume}"}} {seconds}'
+                  for volume, seconds in summary["volume_binds"].items()]
+
+        lines.append("# TYPE backup_job_duration_seconds gauge")
+        for job, timings in summary["jobs"].items():
+            lines += [f'backup_job_duration_seconds{{{labels},job="{job}",stage="{stage}"}} {seconds}'
+                      for stage, seconds in timings.items()]
+
+        for field in ["files", "bytes", "cached_files", "hashed_files", "cached_file_ratio", "errors"]:
+            lines.append(f"# TYPE backup_kopia_{field} gauge")
+            lines += [f'backup_kopia_{field}{{{labels},source="{source}"}} {result[field]}'
+                      for source, result in summary["kopia"].items() if result.get(field) is not None]
+
+        lines.append("# TYPE backup_api_calls_total counter")
+        lines += [f'backup_api_calls_total{{{labels},call="{call}"}} {stats["count"]}'
+                  for call, stats in summary["api_calls"].items()]
+
+        lines.append("# TYPE backup_api_call_duration_seconds_sum counter")
+        lines += [f'backup_api_call_duration_seconds_sum{{{labels},call="{call}"}} {stats["seconds"]}'
+                  for call, stats in summary["api_calls"].items()]
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
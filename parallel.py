@@ -0,0 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def map_concurrently(fn, items: dict, concurrency: int) -> dict:
+    if not items:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {key: executor.submit(fn, value) for key, value in items.items()}
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,204 @@
+import threading
+from contextlib import contextmanager
+
+from kubernetes import client, config
+from kubernetes.utils import parse_quantity
+
+from backup import Backup, BackupContext, ExecResult, ExposedSnapshotPvc, SnapshotInfo
+from cache import ResourceCache
+from job import BackupJob
+from main import BackupDefinition, get_current_namespace, skip_unchanged_volumes
+from postgres import PostgresBackup
+from state import BackupHistoryStore, VolumeStateStore
+
+
+class BackupPlan:
+    def __init__(self, application, namespace):
+        self.application = application
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.current_phase = None
+        self.steps: list[dict] = []
+        self.snapshots: dict[str, SnapshotInfo] = {}
+        self.estimate: dict[str, float | None] = {}
+
+    def add(self, action, **details):
+        with self.lock:
+            self.steps.append({"phase": self.current_phase, "action": action, **details})
+
+    def restore_bytes(self) -> int:
+        return sum(int(parse_quantity(snapshot.size)) for snapshot in self.snapshots.values() if snapshot.size)
+
+    def to_dict(self) -> dict:
+        return {
+            "application": self.application,
+            "namespace": self.namespace,
+            "steps": self.steps,
+            "volumes": {name: {"snapshot": snapshot.name, "size": snapshot.size,
+                               "storage_class": snapshot.storage_class}
+                        for name, snapshot in self.snapshots.items()},
+            "restore_bytes": self.restore_bytes(),
+            "estimate": self.estimate,
+        }
+
+
+# The stand-ins below read from the cluster like a real run, but record every write in the plan instead
+
+class PlanningJob(BackupJob):
+    def __init__(self, api_client, owner, namespace, plan: BackupPlan):
+        super().__init__(api_client, owner, namespace)
+        self.plan = plan
+
+    def run_job(self, job: client.V1Job, output_parser=None):
+        pod_spec = job.spec.template.spec
+        container = pod_spec.containers[0]
+        claims = {volume.name: volume.persistent_volume_claim.claim_name
+                  for volume in pod_spec.volumes or [] if volume.persistent_volume_claim is not None}
+
+        self.plan.add("job",
+                      name=job.metadata.generate_name,
+                      image=container.image,
+                      command=container.command,
+                      mounts={mount.mount_path: claims.get(mount.name, mount.name) for mount in container.volume_mounts or []},
+                      manifest=self.redact(self.client.sanitize_for_serialization(job)))
+
+    def redact(self, manifest: dict) -> dict:
+        # Plain env values carry secrets like KOPIA_PASSWORD and the plan ends up in the pod logs,
+        # only valueFrom references are safe to print
+        pod_spec = manifest["spec"]["template"]["spec"]
+        for container in pod_spec.get("containers", []) + pod_spec.get("initContainers", []):
+            for env in container.get("env", []):
+                if "value" in env:
+                    env["value"] = "<redacted>"
+
+        return manifest
+
+    def delete_owned_jobs(self):
+        pass
+
+
+class PlanningBackup(Backup):
+    def __init__(self, api_client, owner, namespace, plan: BackupPlan, cache: ResourceCache = None):
+        super().__init__(api_client, owner, namespace, cache=cache)
+        self.plan = plan
+        self.jobs = PlanningJob(api_client, owner, namespace, plan)
+
+    def exec_in_pod(self, pod_name, command, timeout=300) -> ExecResult:
+        self.plan.add("exec", pod=pod_name, command=command)
+        return ExecResult(pod_name, 0, "", "")
+
+    def create_snapshot(self, pvc_name: str, snapshot_class=None, storage_class=None) -> SnapshotInfo:
+        pvc = self.cache.get("persistentvolumeclaims", pvc_name)
+        if pvc is None:
+            raise Exception(f'PVC {pvc_name} not found in namespace {self.namespace}')
+
+        # The snapshot restores to the size of its source
+        size = self.pvc_size(pvc)
+        storage_class = storage_class or pvc.spec.storage_class_name
+        self.plan.add("snapshot", pvc=pvc_name, size=size, storage_class=storage_class, snapshot_class=snapshot_class)
+
+        return SnapshotInfo(f"{pvc_name}-snap", size, storage_class)
+
+    def create_group_snapshot(self, pvc_names: dict[str, str], pvcs: dict[str, client.V1PersistentVolumeClaim],
+                              selector: dict[str, str], group_snapshot_class, version) -> dict[str, SnapshotInfo]:
+        self.plan.add("group snapshot", pvcs=list(pvc_names.values()), selector=selector,
+                      group_snapshot_class=group_snapshot_class)
+
+        return {name: SnapshotInfo(f"{pvc_name}-snap", self.pvc_size(pvcs[pvc_name]),
+                                   pvcs[pvc_name].spec.storage_class_name)
+                for name, pvc_name in pvc_names.items()}
+
+    def wait_for_snapshots(self, snapshots: dict[str, SnapshotInfo], timeout=3600, cut_only=False):
+        pass
+
+    def expose_snapshot(self, snapshot) -> ExposedSnapshotPvc:
+        self.plan.add("clone", snapshot=snapshot.name, size=snapshot.size, storage_class=snapshot.storage_class)
+        return ExposedSnapshotPvc(f"{snapshot.name}-clone", snapshot)
+
+    def wait_for_exposed_pvcs(self, exposes: dict[str, ExposedSnapshotPvc], timeout=3600) -> dict[str, ExposedSnapshotPvc]:
+        return exposes
+
+    def cleanup(self):
+        pass
+
+    def pvc_size(self, pvc: client.V1PersistentVolumeClaim):
+        if pvc.status is not None and pvc.status.capacity:
+            return pvc.status.capacity.get("storage")
+
+        return pvc.spec.resources.requests.get("storage")
+
+
+class PlanningContext(BackupContext):
+    def __init__(self, backup: PlanningBackup, postgres: PostgresBackup, scratch_volume, application=None,
+                 cache_volume=None):
+        super().__init__(backup, postgres, scratch_volume, application, cache_volume)
+        self.plan = backup.plan
+
+    @contextmanager
+    def phase(self, name):
+        self.plan.current_phase = name
+        yield
+
+
+def estimate(plan: BackupPlan, history: dict | None) -> dict[str, float | None]:
+    # Durations of the last run, the upload scaled by the bytes to restore now compared to then
+    if history is None:
+        return {"downtime": None, "kopia": None, "duration": None}
+
+    phases = history.get("phases", {})
+    past_bytes = sum(history.get("snapshot_sizes", {}).values())
+    restore_bytes = plan.restore_bytes()
+
+    kopia = phases.get("kopia")
+    if kopia is not None and past_bytes:
+        kopia = kopia * restore_bytes / past_bytes
+
+    duration = history.get("duration")
+    if duration is not None and kopia is not None:
+        duration = duration - phases.get("kopia", 0) + kopia
+
+    return {"downtime": phases.get("downtime"), "kopia": kopia, "duration": duration}
+
+
+def plan_backup(definition: BackupDefinition, api_client=None, namespace=None) -> BackupPlan:
+    if api_client is None:
+        configuration = config.load_incluster_config()
+
+        with client.ApiClient(configuration) as api_client:
+            return plan_backup(definition, api_client, namespace)
+
+    if namespace is None:
+        namespace = definition.namespace() or get_current_namespace()
+
+    application = definition.application()
+    scratch_volume = definition.scratch_volume()
+    plan = BackupPlan(application, namespace)
+
+    cache = ResourceCache(api_client, namespace)
+    backup = PlanningBackup(api_client, application, namespace, plan, cache=cache)
+    postgres = PostgresBackup(api_client, application, namespace, cache=cache, jobs=backup.jobs)
+    ctx = PlanningContext(backup, postgres, scratch_volume, application, definition.cache_volume())
+
+    try:
+        snapshots = definition.prepare_snapshots(ctx)
+
+        if definition.incremental() and definition.per_volume_snapshots():
+            snapshots = skip_unchanged_volumes(VolumeStateStore(api_client, application, namespace), snapshots)
+
+        plan.snapshots = snapshots
+
+        with ctx.phase("expose"):
+            exposes = backup.expose_snapshots(snapshots)
+
+        with ctx.phase("kopia"):
+            if definition.per_volume_snapshots():
+                backup.run_kopia_per_volume(application, scratch_volume, definition.cache_volume(), exposes,
+                                            options=definition.kopia_options())
+            else:
+                backup.run_kopia(application, scratch_volume, definition.cache_volume(), exposes,
+                                 options=definition.kopia_options())
+    finally:
+        cache.close()
+
+    plan.estimate = estimate(plan, BackupHistoryStore(api_client, application, namespace).load())
+    return plan
@@ -1,36 +1,72 @@
 from kubernetes import client
 from kubernetes.client import CoreV1Api
 
+from cache import ResourceCache
 from job import BackupJob
+from limits import BackupLimits
+from metrics import BackupMetrics
+from parallel import map_concurrently
+from repository import KOPIA_IMAGE, KopiaSnapshotResult, kopia_connect_command, kopia_env, kopia_security_context
+
+# Kopia reads the dump from this pipe, the file name is what ends up in the snapshot
+STREAM_SCRIPT = """
+set -u
+export PATH=/tools:$PATH
+{connect} || exit 1
+mkfifo /tmp/{name}.dump
+kopia snapshot create - --stdin-file={name}.dump --override-source={source} --no-progress < /tmp/{name}.dump &
+kopia_pid=$!
+# Keep the pipe open until pg_dump succeeded, a failed dump must not be committed as a complete snapshot
+exec 3>/tmp/{name}.dump
+if ! pg_dump -Fc >&3; then
+  kill -9 $kopia_pid
+  exit 1
+fi
+exec 3>&-
+wait $kopia_pid
+"""
+
 
 class PostgresBackup:
-    def __init__(self, api_client, owner, namespace):
+    def __init__(self, api_client, owner, namespace, metrics: BackupMetrics = None, limits: BackupLimits = None,
+                 run_id=None, cache: ResourceCache = None, jobs: BackupJob = None):
         self.client = api_client
         self.core_v1: CoreV1Api = client.CoreV1Api(api_client)
         self.apps_v1 = client.AppsV1Api(api_client)
         self.custom_api = client.CustomObjectsApi(api_client)
-        self.jobs = BackupJob(api_client, owner, namespace)
+        self.cache = cache if cache is not None else ResourceCache(api_client, namespace)
+        self.jobs = jobs if jobs is not None else BackupJob(api_client, owner, namespace, metrics=metrics, run_id=run_id)
         self.owner = owner
         self.namespace = namespace
+        self.limits = limits if limits is not None else BackupLimits()
 
-    def dump_postgres(self, name, scratch_volume="scratch"):
-        group = "postgresql.cnpg.io"
-        version = "v1"
-
-        cluster = self.custom_api.get_namespaced_custom_object(
-            group=group,
-            version=version,
-            namespace=self.namespace,
-            plural="clusters",
-            name = name,
-        )
+    def dump_postgres_clusters(self, names: list[str], scratch_volume="scratch", dump_format="custom", parallel=None):
+        # Every cluster gets its own job, all of them are started at once and awaited together
+        map_concurrently(lambda name: self.dump_postgres(name, scratch_volume, dump_format, parallel),
+                         {name: name for name in names}, len(names))
 
+    def dump_postgres(self, name, scratch_volume="scratch", dump_format="custom", parallel=None):
+        cluster = self.get_cluster(name)
         image = cluster['status']['image']
 
-        command = [
-            "pg_dump", "-Fc", "-f",
-            f'/scratch/{name}.dump'
-        ]
+        if dump_format == "custom":
+            dump = f'/scratch/{name}.dump'
+            command = [
+                "pg_dump", "-Fc", "-f",
+                dump
+            ]
+        elif dump_format == "directory":
+            # pg_dump -j only works with the directory format, which refuses to write into an existing dump
+            if parallel is None:
+                parallel = cluster['spec'].get('instances', 1)
+
+            dump = f'/scratch/{name}.dir'
+            command = [
+                "bash", "-c",
+                f'rm -rf {dump} && pg_dump -Fd -j {int(parallel)} -f {dump}'
+            ]
+        else:
+            raise ValueError(f'Unsupported dump format {dump_format}')
 
         volume_mounts = [client.V1VolumeMount(
             name="scratch",
@@ -41,7 +77,118 @@ class PostgresBackup:
             client.V1Volume(name="scratch", persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(claim_name=scratch_volume)),
         ]
 
-        env = [
+        env = self.connection_env(name)
+
+        job = self.jobs.create_job_object(f'backup-{name}', image, command, volume_mounts, volumes, env)
+        with self.limits.dumps:
+            self.jobs.run_job(job)
+
+        if self.jobs.metrics is not None:
+            self.jobs.metrics.record_dump(name, dump)
+
+    def verify_dump(self, name, dump, scratch_volume="scratch"):
+        # Reading the table of contents fails on a truncated or corrupt dump without touching the database
+        image = self.get_cluster(name)['status']['image']
+        command = ["bash", "-c", f'pg_restore --list {dump} > /dev/null']
+
+        volume_mounts = [client.V1VolumeMount(name="scratch", mount_path="/scratch", read_only=True)]
+
+        volumes = [
+            client.V1Volume(name="scratch", persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                claim_name=scratch_volume, read_only=True)),
+        ]
+
+        job = self.jobs.create_job_object(f'verify-{name}', image, command, volume_mounts, volumes, [])
+        self.jobs.run_job(job)
+
+    def restore_postgres_clusters(self, names: list[str], scratch_volume="scratch", dump_format="custom", parallel=4):
+        map_concurrently(lambda name: self.restore_postgres(name, scratch_volume, dump_format, parallel),
+                         {name: name for name in names}, len(names))
+
+    def restore_postgres(self, name, scratch_volume="scratch", dump_format="custom", parallel=4):
+        cluster = self.get_cluster(name)
+        image = cluster['status']['image']
+
+        # pg_restore -j needs a seekable dump, both the custom and the directory format are
+        if dump_format == "custom":
+            dump = f'/scratch/{name}.dump'
+        elif dump_format == "directory":
+            dump = f'/scratch/{name}.dir'
+        else:
+            raise ValueError(f'Unsupported dump format {dump_format}')
+
+        command = [
+            "bash", "-c",
+            f'pg_restore -j {int(parallel)} --clean --if-exists --no-owner -d "$PGDATABASE" {dump}'
+        ]
+
+        volume_mounts = [client.V1VolumeMount(name="scratch", mount_path="/scratch", read_only=True)]
+
+        volumes = [
+            client.V1Volume(name="scratch", persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                claim_name=scratch_volume, read_only=True)),
+        ]
+
+        job = self.jobs.create_job_object(f'restore-{name}', image, command, volume_mounts, volumes,
+                                          self.connection_env(name))
+        with self.limits.dumps:
+            self.jobs.run_job(job)
+
+    def stream_postgres_clusters(self, names: list[str], application: str, cache_volume: str):
+        map_concurrently(lambda name: self.stream_postgres(name, application, cache_volume),
+                         {name: name for name in names}, len(names))
+
+    def stream_postgres(self, name, application: str, cache_volume: str):
+        cluster = self.get_cluster(name)
+        image = cluster['status']['image']
+
+        # pg_dump and kopia run in one container, the kopia binary is copied over from its own image
+        source = f'/k8s/{self.namespace}/{application}/postgres-{name}'
+        script = STREAM_SCRIPT.format(connect=kopia_connect_command(f"/cache/{application}/postgres-{name}"),
+                                      name=name,
+                                      source=source)
+        command = ["bash", "-c", script]
+
+        volume_mounts = [
+            client.V1VolumeMount(name="tools", mount_path="/tools"),
+            client.V1VolumeMount(name="cache", mount_path="/cache"),
+        ]
+
+        volumes = [
+            client.V1Volume(name="tools", empty_dir=client.V1EmptyDirVolumeSource()),
+            client.V1Volume(name="cache", persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(claim_name=cache_volume)),
+        ]
+
+        init_containers = [
+            client.V1Container(
+                name="kopia",
+                image=KOPIA_IMAGE,
+                command=["cp", "/bin/kopia", "/tools/kopia"],
+                volume_mounts=[client.V1VolumeMount(name="tools", mount_path="/tools")],
+            )
+        ]
+
+        env = self.connection_env(name) + kopia_env()
+
+        job = self.jobs.create_job_object(f'backup-{name}', image, command, volume_mounts, volumes, env,
+                                          security_context=kopia_security_context(),
+                                          init_containers=init_containers)
+        result = KopiaSnapshotResult(source)
+        with self.limits.dumps:
+            self.jobs.run_job(job, output_parser=result)
+
+        if self.jobs.metrics is not None:
+            self.jobs.metrics.record_kopia(f"postgres-{name}", result.to_dict())
+
+    def get_cluster(self, name):
+        cluster = self.cache.get("clusters", name)
+        if cluster is None:
+            raise Exception(f'Postgres cluster {name} not found in namespace {self.namespace}')
+
+        return cluster
+
+    def connection_env(self, name) -> list[client.V1EnvVar]:
+        return [
             client.V1EnvVar(name="PGHOST", value_from=client.V1EnvVarSource(
                 secret_key_ref=client.V1SecretKeySelector(key="host", name=name + "-app"))),
             client.V1EnvVar(name="PGPORT", value_from=client.V1EnvVarSource(
@@ -53,6 +200,3 @@ class PostgresBackup:
             client.V1EnvVar(name="PGDATABASE", value_from=client.V1EnvVarSource(
                 secret_key_ref=client.V1SecretKeySelector(key="dbname", name=name + "-app")))
         ]
-
-        job = self.jobs.create_job_object(f'backup-{name}', image, command, volume_mounts, volumes, env)
-        self.jobs.run_job(job)
\ No newline at end of file
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import math
+import os
+import re
+
+from kubernetes import client
+from kubernetes.utils import parse_quantity
+
+KOPIA_IMAGE = "kopia/kopia:0.22.3"
+
+
+def kopia_connect_command(cache_directory="/cache", options: "KopiaOptions" = None) -> str:
+    repository = os.environ["REPOSITORY_URL"]
+    username = os.environ.get("REPOSITORY_USERNAME", "default")
+    hostname = os.environ.get("REPOSITORY_HOSTNAME", "default")
+    server_fingerprint = os.environ.get("SERVER_FINGERPRINT")
+
+    args = [
+        "--disable-file-logging",
+        "--no-check-for-updates",
+        "--no-persist-credentials",
+        "--cache-directory", f"{cache_directory}/cache",
+        "--url", f'"{repository}"',
+        f"--override-username='{username}'",
+        f"--override-hostname='{hostname}'"
+    ]
+
+    if server_fingerprint is not None:
+        args.append("--server-cert-fingerprint")
+        args.append(server_fingerprint)
+
+    if options is not None:
+        args += options.cache_args()
+
+    connect = "kopia repository connect server " + " ".join(args)
+
+    # The config lives on the cache volume next to the cache. It is reused as long as it was created with
+    # the same arguments and the server still accepts it, which skips the connect and the cold index sync.
+    config_path = f"{cache_directory}/repository.config"
+    connection_id = hashlib.sha256(connect.encode()).hexdigest()
+
+    return f"""export KOPIA_CONFIG_PATH={config_path} \
+        && if [ "$(cat {config_path}.id 2>/dev/null)" = "{connection_id}" ] && kopia repository status >/dev/null 2>&1; then \
+            echo "Reusing kopia connection {config_path}"; \
+        else \
+            mkdir -p {cache_directory} && {connect} && echo "{connection_id}" > {config_path}.id; \
+        fi"""
+
+
+def kopia_env() -> list[client.V1EnvVar]:
+    return [
+        client.V1EnvVar(name="KOPIA_PASSWORD", value=os.environ.get("REPOSITORY_PASSWORD")),
+    ]
+
+
+def kopia_security_context() -> client.V1PodSecurityContext:
+    return client.V1PodSecurityContext(
+        run_as_group=0,
+        run_as_user=0,
+        run_as_non_root=False,
+        seccomp_profile=client.V1SeccompProfile(type="RuntimeDefault")
+    )
+
+
+class KopiaOptions:
+    def __init__(self, parallel: int | None = None, compression: str | None = None,
+                 cpu: str | None = None, memory: str | None = None, gomaxprocs: int | None = None,
+                 content_cache_mb: int | None = None, metadata_cache_mb: int | None = None,
+                 json_output: bool = True):
+        self.parallel = parallel
+        self.compression = compression
+        self.cpu = cpu
+        self.memory = memory
+        self.gomaxprocs = gomaxprocs
+        self.content_cache_mb = content_cache_mb
+        self.metadata_cache_mb = metadata_cache_mb
+        self.json_output = json_output
+
+    def sized_for(self, sizes: list[str | None]) -> "KopiaOptions":
+        # Roughly one core per 100Gi of source data, kopia's hashing scales with the number of parallel uploads
+        total = sum(parse_quantity(size) for size in sizes if size is not None)
+        cores = min(8, max(1, math.ceil(total / (100 * 1024 ** 3))))
+
+        return KopiaOptions(
+            parallel=self.parallel if self.parallel is not None else cores * 2,
+            compression=self.compression,
+            cpu=self.cpu if self.cpu is not None else str(cores),
+            memory=self.memory if self.memory is not None else f'{1024 + 512 * cores}Mi',
+            gomaxprocs=self.gomaxprocs if self.gomaxprocs is not None else cores,
+            content_cache_mb=self.content_cache_mb,
+            metadata_cache_mb=self.metadata_cache_mb,
+            json_output=self.json_output,
+        )
+
+    def cache_args(self) -> list[str]:
+        args = []
+        if self.content_cache_mb is not None:
+            args.append(f"--content-cache-size-limit-mb={self.content_cache_mb}")
+        if self.metadata_cache_mb is not None:
+            args.append(f"--metadata-cache-size-limit-mb={self.metadata_cache_mb}")
+
+        return args
+
+    def snapshot_args(self) -> str:
+        args = []
+        if self.parallel is not None:
+            args.append(f"--parallel={self.parallel}")
+        if self.json_output:
+            # Prints the snapshot manifest, kopia only includes its statistics with --json-verbose.
+            # See KopiaSnapshotResult.
+            args.append("--json --json-verbose")
+
+        return " ".join(args)
+
+    def verify_args(self) -> str:
+        if self.parallel is None:
+            return ""
+
+        return f"--parallel={self.parallel} --file-parallelism={self.parallel}"
+
+    def restore_args(self) -> str:
+        if self.parallel is None:
+            return ""
+
+        return f"--parallel={self.parallel}"
+
+    def policy_command(self, source: str) -> str | None:
+        if self.compression is None:
+            return None
+
+        return f"kopia policy set {source} --compression={self.compression}"
+
+    def env(self) -> list[client.V1EnvVar]:
+        if self.gomaxprocs is None:
+            return []
+
+        return [client.V1EnvVar(name="GOMAXPROCS", value=str(self.gomaxprocs))]
+
+    def resources(self) -> client.V1ResourceRequirements | None:
+        requests = {}
+        if self.cpu is not None:
+            requests["cpu"] = self.cpu
+        if self.memory is not None:
+            requests["memory"] = self.memory
+
+        if not requests:
+            return None
+
+        # No CPU limit, kopia may use idle cores but memory is capped to protect the node
+        limits = {"memory": self.memory} if self.memory is not None else None
+        return client.V1ResourceRequirements(requests=requests, limits=limits)
+
+
+SNAPSHOT_CREATED = re.compile(r"Created snapshot with root (\S+) and ID (\S+)")
+
+
+# Collects what `kopia snapshot create` reports about a snapshot from its output, line by line: the manifest
+# printed with --json --json-verbose and the final "Created snapshot" line. Progress output is disabled in the
+# jobs, so all statistics come from the manifest.
+class KopiaSnapshotResult:
+    def __init__(self, source: str | None = None):
+        self.source = source
+        self.snapshot_id: str | None = None
+        self.root: str | None = None
+        self.files: int | None = None
+        self.directories: int | None = None
+        self.bytes: int | None = None
+        self.cached_files: int | None = None
+        self.hashed_files: int | None = None
+        self.errors: int | None = None
+
+    def feed(self, line: str):
+        line = line.strip()
+
+        if line.startswith("{") and line.endswith("}"):
+            try:
+                manifest = json.loads(line)
+            except ValueError:
+                return
+            self.feed_manifest(manifest)
+            return
+
+        created = SNAPSHOT_CREATED.search(line)
+        if created is not None:
+            self.root, self.snapshot_id = created.group(1), created.group(2)
+
+    def feed_manifest(self, manifest: dict):
+        stats = manifest.get("stats")
+        if stats is None:
+            return
+
+        self.snapshot_id = manifest.get("id", self.snapshot_id)
+        self.root = (manifest.get("rootEntry") or {}).get("obj", self.root)
+        self.files = stats.get("fileCount", self.files)
+        self.directories = stats.get("dirCount", self.directories)
+        self.bytes = stats.get("totalSize", self.bytes)
+        self.cached_files = stats.get("cachedFiles", self.cached_files)
+        self.hashed_files = stats.get("nonCachedFiles", self.hashed_files)
+        self.errors = stats.get("errorCount", self.errors)
+
+    def cached_file_ratio(self) -> float | None:
+        # Share of files kopia found unchanged in its file cache and neither read nor hashed again. This is not
+        # deduplication, the manifest has no byte counts for hashing or uploading.
+        if not self.files or self.cached_files is None:
+            return None
+
+        return self.cached_files / self.files
+
+    def to_dict(self) -> dict:
+        return {
+            "source": self.source,
+            "snapshot_id": self.snapshot_id,
+            "root": self.root,
+            "files": self.files,
+            "directories": self.directories,
+            "bytes": self.bytes,
+            "cached_files": self.cached_files,
+            "hashed_files": self.hashed_files,
+            "cached_file_ratio": self.cached_file_ratio(),
+            "errors": self.errors,
+        }
+
+
+# Collects the output of `kopia snapshot list --json`, an array of snapshot manifests which kopia spreads over
+# several lines. Lets several restore jobs read one and the same snapshot.
+class KopiaSnapshotList:
+    def __init__(self):
+        self.lines: list[str] | None = None
+
+    def feed(self, line: str):
+        line = line.strip()
+        if self.lines is None:
+            if not line.startswith("["):
+                return
+            self.lines = []
+
+        self.lines.append(line)
+
+    def manifests(self) -> list[dict]:
+        if self.lines is None:
+            return []
+
+        manifests, end = json.JSONDecoder().raw_decode("".join(self.lines))
+        return manifests
+
+    def select(self, snapshot_time="latest") -> dict | None:
+        # Like --snapshot-time of `kopia snapshot restore`: the newest snapshot, or the newest one started at or
+        # before the given time
+        manifests = sorted(self.manifests(), key=lambda manifest: manifest["startTime"])
+        if snapshot_time != "latest":
+            manifests = [manifest for manifest in manifests if manifest["startTime"][:19] <= snapshot_time[:19]]
+
+        return manifests[-1] if manifests else None
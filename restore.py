@@ -0,0 +1,289 @@
+import copy
+import os
+import uuid
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from cache import ResourceCache
+from job import BackupJob
+from labels import BACKUP_RESTORED_FROM_LABEL
+from limits import BackupLimits
+from main import get_current_namespace
+from metrics import BackupMetrics
+from parallel import map_concurrently
+from postgres import PostgresBackup
+from repository import KOPIA_IMAGE, KopiaOptions, KopiaSnapshotList, kopia_connect_command, kopia_env, \
+    kopia_security_context
+
+
+class RestoreTarget:
+    def __init__(self, claim_name, size, storage_class=None, access_modes: list[str] = None):
+        self.claim_name = claim_name
+        self.size = size
+        self.storage_class = storage_class
+        self.access_modes = access_modes or ["ReadWriteOnce"]
+
+
+class RestoreDefinition:
+    def volumes(self) -> dict[str, RestoreTarget]:
+        # The volume names used by capture, e.g. {"data": RestoreTarget("nextcloud-data-new", "500Gi")}
+        return {}
+
+    def postgres_clusters(self) -> list[str]:
+        return []
+
+    def streamed_postgres(self) -> bool:
+        # True if the dumps were streamed into kopia by stream_postgres instead of written to the scratch volume
+        return False
+
+    def dump_format(self) -> str:
+        return "custom"
+
+    def pg_restore_jobs(self) -> int:
+        return 4
+
+    def snapshot_time(self) -> str:
+        return "latest"
+
+    def scratch_volume(self) -> str | None:
+        return None
+
+    def cache_volume(self) -> str | None:
+        return None
+
+    def application(self) -> str | None:
+        pass
+
+    def namespace(self) -> str | None:
+        return None
+
+    def per_volume_snapshots(self) -> bool:
+        return False
+
+    def kopia_options(self) -> KopiaOptions:
+        return KopiaOptions()
+
+
+# The way back of Backup.run_kopia and run_kopia_per_volume: the same kopia sources below /k8s/<ns>/<app>,
+# restored into freshly created PVCs by one job per volume.
+class Restore:
+    def __init__(self, api_client, owner, namespace, concurrency=4, metrics: BackupMetrics = None,
+                 limits: BackupLimits = None, run_id=None, cache: ResourceCache = None):
+        self.core_v1 = client.CoreV1Api(api_client)
+        self.owner = owner
+        self.namespace = namespace
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.limits = limits if limits is not None else BackupLimits()
+        self.cache = cache if cache is not None else ResourceCache(api_client, namespace)
+        self.jobs = BackupJob(api_client, owner, namespace, metrics=metrics, run_id=run_id)
+
+    def create_target_pvcs(self, targets: dict[str, RestoreTarget]):
+        map_concurrently(self.create_target_pvc, targets, self.concurrency)
+
+    def create_target_pvc(self, target: RestoreTarget):
+        if self.cache.get("persistentvolumeclaims", target.claim_name) is not None:
+            print(f"Restoring into existing PVC {target.claim_name}")
+            return
+
+        pvc = client.V1PersistentVolumeClaim(
+            metadata=client.V1ObjectMeta(
+                name=target.claim_name,
+                labels={BACKUP_RESTORED_FROM_LABEL: self.owner}
+            ),
+            spec=client.V1PersistentVolumeClaimSpec(
+                access_modes=target.access_modes,
+                resources=client.V1ResourceRequirements(
+                    requests={"storage": target.size},
+                ),
+                storage_class_name=target.storage_class,
+            )
+        )
+
+        try:
+            self.core_v1.create_namespaced_persistent_volume_claim(namespace=self.namespace, body=pvc)
+        except ApiException as e:
+            # Created in the meantime, e.g. by the application's chart
+            if e.status != 409:
+                raise
+
+    def restore_per_volume(self, application: str, cache_volume: str, sources: dict[str, tuple[str, str | None]],
+                           snapshot_time="latest", concurrency=None, options: KopiaOptions = None):
+        if options is None:
+            options = KopiaOptions()
+
+        # Every source gets its own job, so the restores are spread over several pods and nodes like the uploads
+        claims = {name: (name, claim_name, options.sized_for([size])) for name, (claim_name, size) in sources.items()}
+
+        map_concurrently(lambda claim: self.restore_volume(application, cache_volume, *claim, snapshot_time),
+                         claims, concurrency or self.concurrency)
+
+    def restore_volume(self, application: str, cache_volume: str, name: str, claim_name: str, options: KopiaOptions,
+                       snapshot_time="latest", source: str = None):
+        # Same config and cache directory as the upload of this source, a warm index cache shortens the restore.
+        # A source given as object ID already names the snapshot.
+        if source is None:
+            source = f'/k8s/{self.namespace}/{application}/{name}'
+        else:
+            snapshot_time = None
+
+        command = self.kopia_restore_command(source, f"/cache/{application}/{name}", options, snapshot_time)
+
+        volume_mounts = [
+            client.V1VolumeMount(name="cache", mount_path="/cache"),
+            client.V1VolumeMount(name="data", mount_path="/data"),
+        ]
+
+        volumes = [
+            client.V1Volume(name="cache",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=cache_volume)),
+            client.V1Volume(name="data",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=claim_name)),
+        ]
+
+        job = self.jobs.create_job_object(f'restore-kopia-{name}-', KOPIA_IMAGE, command, volume_mounts, volumes,
+                                          security_context=kopia_security_context(), env=kopia_env() + options.env(),
+                                          resources=options.resources())
+        with self.limits.kopia:
+            self.jobs.run_job(job)
+
+    def restore_tree(self, application: str, cache_volume: str, sources: dict[str, tuple[str, str | None]],
+                     snapshot_time="latest", concurrency=None, options: KopiaOptions = None):
+        if options is None:
+            options = KopiaOptions()
+
+        # run_kopia uploads every volume as a directory of one source. Its snapshot is picked once, then every
+        # directory with a target PVC is restored by a job of its own like restore_per_volume does. Directories
+        # without a target are left out instead of being written to a pod's ephemeral storage.
+        root = self.find_snapshot(application, cache_volume, f'/k8s/{self.namespace}/{application}/', snapshot_time)
+        claims = {name: (name, claim_name, options.sized_for([size])) for name, (claim_name, size) in sources.items()}
+
+        map_concurrently(lambda claim: self.restore_volume(application, cache_volume, *claim,
+                                                           source=f"{root}/{claim[0]}"),
+                         claims, concurrency or self.concurrency)
+
+    def find_snapshot(self, application: str, cache_volume: str, source: str, snapshot_time="latest") -> str:
+        connect = kopia_connect_command(f"/cache/{application}")
+        command = ["bash", "-c", f"{connect} && kopia snapshot list {source} --json"]
+
+        volume_mounts = [client.V1VolumeMount(name="cache", mount_path="/cache")]
+        volumes = [
+            client.V1Volume(name="cache",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=cache_volume)),
+        ]
+
+        job = self.jobs.create_job_object(f'restore-kopia-list', KOPIA_IMAGE, command, volume_mounts, volumes,
+                                          security_context=kopia_security_context(), env=kopia_env())
+        snapshots = KopiaSnapshotList()
+        self.jobs.run_job(job, output_parser=snapshots)
+
+        manifest = snapshots.select(snapshot_time)
+        if manifest is None:
+            raise Exception(f'No snapshot of {source} found for {snapshot_time}')
+
+        print(f"Restoring snapshot {manifest['id']} of {source} taken at {manifest['startTime']}")
+        return manifest["rootEntry"]["obj"]
+
+    def kopia_restore_command(self, source: str, cache_directory: str, options: KopiaOptions,
+                              snapshot_time: str | None = "latest") -> list[str]:
+        connect = kopia_connect_command(cache_directory, options)
+        restore = f"kopia snapshot restore {source} /data {options.restore_args()}"
+        if snapshot_time is not None:
+            restore += f" --snapshot-time={snapshot_time}"
+
+        return ["bash", "-c", f"{connect} && {restore}"]
+
+
+def restore_backup(definition: RestoreDefinition, api_client=None, namespace=None,
+                   limits: BackupLimits = None) -> BackupMetrics:
+    if api_client is None:
+        configuration = config.load_incluster_config()
+
+        with client.ApiClient(configuration) as api_client:
+            return restore_backup(definition, api_client, namespace, limits)
+
+    if namespace is None:
+        namespace = definition.namespace() or get_current_namespace()
+
+    if limits is None:
+        limits = BackupLimits.from_environment(api_client)
+
+    api_client = copy.copy(api_client)
+
+    application = definition.application()
+    scratch_volume = definition.scratch_volume()
+    cache_volume = definition.cache_volume()
+    targets = definition.volumes()
+    clusters = definition.postgres_clusters()
+
+    if clusters and scratch_volume is None:
+        raise ValueError("Restoring Postgres clusters requires a scratch volume for their dumps")
+
+    concurrency = int(os.environ.get("RESTORE_CONCURRENCY", "4"))
+
+    metrics = BackupMetrics(application, namespace)
+    metrics.instrument(api_client)
+
+    run_id = uuid.uuid4().hex[:12]
+    cache = ResourceCache(api_client, namespace)
+    restore = Restore(api_client, application, namespace, concurrency=concurrency, metrics=metrics, limits=limits,
+                      run_id=run_id, cache=cache)
+    postgres = PostgresBackup(api_client, application, namespace, metrics=metrics, limits=limits, run_id=run_id,
+                              cache=cache, jobs=restore.jobs)
+
+    # Kopia source name to the claim it is restored into and the size the job is sized for
+    sources = {name: (target.claim_name, target.size) for name, target in targets.items()}
+    if clusters and definition.streamed_postgres():
+        streams = {f"postgres-{cluster}": (scratch_volume, None) for cluster in clusters}
+    else:
+        streams = {}
+        if scratch_volume is not None:
+            sources["scratch"] = (scratch_volume, None)
+
+    try:
+        cache.prefetch(["persistentvolumeclaims"])
+
+        with metrics.phase("create pvcs"):
+            restore.create_target_pvcs(targets)
+
+        with metrics.phase("kopia"):
+            if definition.per_volume_snapshots():
+                restore.restore_per_volume(application, cache_volume, sources | streams, definition.snapshot_time(),
+                                           options=definition.kopia_options())
+            else:
+                # Dumps streamed by stream_postgres are sources of their own in either layout
+                runs = {}
+                if sources:
+                    runs["tree"] = lambda: restore.restore_tree(application, cache_volume, sources,
+                                                                definition.snapshot_time(),
+                                                                options=definition.kopia_options())
+                if streams:
+                    runs["streams"] = lambda: restore.restore_per_volume(application, cache_volume, streams,
+                                                                         definition.snapshot_time(),
+                                                                         options=definition.kopia_options())
+
+                map_concurrently(lambda run: run(), runs, 2)
+
+        with metrics.phase("pg_restore"):
+            postgres.restore_postgres_clusters(clusters, scratch_volume, definition.dump_format(),
+                                               definition.pg_restore_jobs())
+
+        metrics.finish(True)
+    except BaseException:
+        metrics.finish(False)
+        raise
+    finally:
+        with metrics.phase("cleanup"):
+            try:
+                restore.jobs.delete_owned_jobs()
+            except Exception as e:
+                print(f"Cleanup of restore {run_id} failed: {e}")
+
+        cache.close()
+
+    print(f"Restore of {application} finished in {metrics.summary()['duration']:.1f} seconds")
+    return metrics
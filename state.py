@@ -0,0 +1,115 @@
+import json
+import os
+from datetime import datetime, timezone
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from labels import BACKUP_OWNER_LABEL
+
+
+class VolumeState:
+    def __init__(self, snapshot, size, change_hint, backed_up_at: datetime):
+        self.snapshot = snapshot
+        self.size = size
+        self.change_hint = change_hint
+        self.backed_up_at = backed_up_at
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "snapshot": self.snapshot,
+            "size": self.size,
+            "changeHint": self.change_hint,
+            "backedUpAt": self.backed_up_at.isoformat(),
+        })
+
+    @staticmethod
+    def from_json(value: str) -> "VolumeState":
+        data = json.loads(value)
+        return VolumeState(data.get("snapshot"), data.get("size"), data.get("changeHint"),
+                           datetime.fromisoformat(data["backedUpAt"]))
+
+
+# Remembers what the last successful upload of each volume looked like, in a ConfigMap per application.
+# Unlike the snapshots and clones of a run it is not cleaned up, so it is only labeled with the owner.
+class VolumeStateStore:
+    def __init__(self, api_client, owner, namespace, max_age=None):
+        self.core_v1 = client.CoreV1Api(api_client)
+        self.owner = owner
+        self.namespace = namespace
+        self.name = f"backup-state-{owner}"
+
+        if max_age is None:
+            max_age = int(os.environ.get("BACKUP_INCREMENTAL_MAX_AGE", str(7 * 86400)))
+
+        # A volume is uploaded again after max_age seconds even if its hint did not change
+        self.max_age = max_age
+
+    def load(self) -> dict[str, VolumeState]:
+        try:
+            config_map = self.core_v1.read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return {}
+
+        return {name: VolumeState.from_json(value) for name, value in (config_map.data or {}).items()}
+
+    def save(self, states: dict[str, VolumeState]):
+        data = {name: state.to_json() for name, state in states.items()}
+        if not data:
+            return
+
+        try:
+            self.core_v1.patch_namespaced_config_map(self.name, self.namespace, {"data": data})
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            config_map = client.V1ConfigMap(
+                metadata=client.V1ObjectMeta(name=self.name, labels={BACKUP_OWNER_LABEL: self.owner}),
+                data=data)
+            self.core_v1.create_namespaced_config_map(self.namespace, config_map)
+
+    def is_unchanged(self, state: VolumeState | None, size, change_hint) -> bool:
+        # Without a hint nothing proves the content is the same, a matching size alone is not enough
+        if state is None or change_hint is None:
+            return False
+
+        age = (datetime.now(timezone.utc) - state.backed_up_at).total_seconds()
+        return state.change_hint == change_hint and state.size == size and age < self.max_age
+
+
+# Keeps the metrics summary of the last successful run of an application, e.g. for the estimates of a plan.
+# The metrics files live in the run's pod and are gone with it.
+class BackupHistoryStore:
+    def __init__(self, api_client, owner, namespace):
+        self.core_v1 = client.CoreV1Api(api_client)
+        self.owner = owner
+        self.namespace = namespace
+        self.name = f"backup-history-{owner}"
+
+    def load(self) -> dict | None:
+        try:
+            config_map = self.core_v1.read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return None
+
+        summary = (config_map.data or {}).get("summary")
+        return json.loads(summary) if summary else None
+
+    def save(self, summary: dict):
+        data = {"summary": json.dumps(summary)}
+
+        try:
+            self.core_v1.patch_namespaced_config_map(self.name, self.namespace, {"data": data})
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            config_map = client.V1ConfigMap(
+                metadata=client.V1ObjectMeta(name=self.name, labels={BACKUP_OWNER_LABEL: self.owner}),
+                data=data)
+            self.core_v1.create_namespaced_config_map(self.namespace, config_map)
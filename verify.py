@@ -0,0 +1,113 @@
+import uuid
+
+from kubernetes import client
+
+from cache import ResourceCache
+from job import BackupJob
+from parallel import map_concurrently
+from postgres import PostgresBackup
+from repository import KOPIA_IMAGE, KopiaOptions, kopia_connect_command, kopia_env, kopia_security_context
+
+
+# Reads back what a finished run uploaded: a sample of the files of every new kopia snapshot and the table of
+# contents of every Postgres dump on the scratch volume. It only needs the run's metrics summary, so it can run
+# after the run's cleanup while other applications are being backed up.
+class BackupVerifier:
+    def __init__(self, api_client, owner, namespace, concurrency=4, cache: ResourceCache = None):
+        self.namespace = namespace
+        self.concurrency = concurrency
+        # A run id of its own, the verification jobs are cleaned up independently of the run they check
+        self.jobs = BackupJob(api_client, owner, namespace, run_id=uuid.uuid4().hex[:12])
+        self.postgres = PostgresBackup(api_client, owner, namespace, cache=cache, jobs=self.jobs)
+
+    def verify(self, application: str, cache_volume: str, scratch_volume: str | None, summary: dict, percent: float,
+               options: KopiaOptions = None) -> list[str]:
+        if options is None:
+            options = KopiaOptions()
+
+        checks = {}
+        for name, result in summary["kopia"].items():
+            if result.get("snapshot_id") or result.get("source"):
+                checks[f"kopia {name}"] = lambda name=name, result=result: \
+                    self.verify_snapshot(application, cache_volume, name, result, percent, options)
+
+        if scratch_volume is not None:
+            for name, dump in summary["dumps"].items():
+                checks[f"dump {name}"] = lambda name=name, dump=dump: self.postgres.verify_dump(name, dump,
+                                                                                                 scratch_volume)
+
+        try:
+            errors = map_concurrently(self.run_check, checks, self.concurrency)
+        finally:
+            self.jobs.delete_owned_jobs()
+
+        problems = self.compare_sizes(summary)
+        problems += [f"{check}: {error}" for check, error in errors.items() if error is not None]
+
+        return problems
+
+    def run_check(self, check) -> str | None:
+        try:
+            check()
+        except Exception as e:
+            return str(e)
+
+        return None
+
+    def verify_snapshot(self, application: str, cache_volume: str, name: str, result: dict, percent: float,
+                        options: KopiaOptions):
+        # A directory of its own per check, so the index syncs neither race each other nor the next upload
+        connect = kopia_connect_command(f"/cache/{application}/verify/{name}", options)
+        target = result.get("snapshot_id") or f"--sources={result['source']}"
+        verify = f"kopia snapshot verify --verify-files-percent={percent} {options.verify_args()} {target}"
+
+        volume_mounts = [client.V1VolumeMount(name="cache", mount_path="/cache")]
+        volumes = [
+            client.V1Volume(name="cache",
+                            persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name=cache_volume)),
+        ]
+
+        job = self.jobs.create_job_object(f'verify-kopia-{name}-', KOPIA_IMAGE, ["bash", "-c", f"{connect} && {verify}"],
+                                          volume_mounts, volumes, security_context=kopia_security_context(),
+                                          env=kopia_env() + options.env(), resources=options.resources())
+        self.jobs.run_job(job)
+
+    def compare_sizes(self, summary: dict) -> list[str]:
+        # The recorded size is the capacity of the source volume, a tree larger than that was not read from it.
+        # Kopia only reports the tree size with --json-verbose, see KopiaOptions.json_output.
+        problems = []
+        sizes = summary["snapshot_sizes"]
+        for name, result in summary["kopia"].items():
+            capacity = sizes.get(name)
+            if name == summary["application"] and capacity is None and sizes and not summary["dumps"]:
+                # A single source holds the tree of every volume. The dumps on the scratch volume would be part of
+                # it as well, which has no recorded capacity.
+                capacity = sum(sizes.values())
+
+            if result.get("bytes") is not None and capacity is not None and result["bytes"] > capacity:
+                problems.append(f"kopia {name}: uploaded {result['bytes']} bytes from a volume of {capacity} bytes")
+
+        return problems
+
+
+def verify_backup(definition, summary: dict, api_client, concurrency=4):
+    percent = definition.verify_percent()
+    if percent is None:
+        return
+
+    application = definition.application()
+    options = definition.kopia_options().sized_for(list(summary["snapshot_sizes"].values()))
+
+    cache = ResourceCache(api_client, summary["namespace"])
+    try:
+        verifier = BackupVerifier(api_client, application, summary["namespace"], concurrency, cache=cache)
+        problems = verifier.verify(application, definition.cache_volume(), definition.scratch_volume(), summary,
+                                   percent, options)
+    finally:
+        cache.close()
+
+    if problems:
+        raise Exception(f'Verification of {application} failed: {"; ".join(problems)}')
+
+    print(f"Verified backup of {application}")